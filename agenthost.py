@@ -0,0 +1,355 @@
+#!/usr/bin/python
+
+# Agent hosts: run agents in separate processes, so that they decide in
+# parallel, and a slow or crashing agent can't take the sim down with it.
+#
+# The sim talks to each host over a multiprocessing Pipe.  Messages are
+# tuples of plain values: Requests, Uploads and Downloads are sent as
+# tuples of their fields, and PeerInfo as (id, pieces, version).  Each
+# phase the sim sends a host what changed since its last message (new
+# rounds of history, pieces, PeerInfo and piece completions), and the
+# ids of the agents to ask.  The host keeps its own copies up to date,
+# calls its agents in order, and sends back their Requests or Uploads.
+
+import time
+import random
+import logging
+import traceback
+import multiprocessing
+
+from messages import Upload, Request, Download, PeerInfo, PeerView, RarityView
+from history import History
+
+
+def encode_request(r):
+    return (r.requester_id, r.peer_id, r.piece_id, r.start)
+
+def decode_request(t):
+    return Request(*t)
+
+def encode_upload(u):
+    return (u.from_id, u.to_id, u.bw)
+
+def decode_upload(t):
+    return Upload(*t)
+
+def encode_download(d):
+    return (d.from_id, d.to_id, d.piece, d.blocks)
+
+def decode_download(t):
+    return Download(*t)
+
+def encode_info(info):
+    return (info.id, tuple(sorted(info.available_pieces)), info.version)
+
+def decode_info(t):
+    return PeerInfo(*t)
+
+
+class HostedPeer(object):
+    """
+    Stands in for an agent that runs in an AgentHost, in the sim's list
+    of peers.  It has what the sim's scheduler looks at; new pieces are
+    passed on to the host with its next message.
+    """
+    def __init__(self, agent_class, id, pieces, up_bw, host):
+        self.id = id
+        self.pieces = pieces
+        self.up_bw = up_bw
+        self.host = host
+        self.needs_every_round = agent_class.needs_every_round
+        self.concurrent = False
+        self.class_name = agent_class.__name__
+
+    def update_pieces(self, new_pieces):
+        self.pieces = new_pieces
+        self.host.new_pieces[self.id] = new_pieces
+
+    def update_rarity(self, rarity):
+        # The host keeps its own RarityView
+        pass
+
+    def __repr__(self):
+        return "%s(id=%s pieces=%s up_bw=%d)" % (
+            self.class_name, self.id, self.pieces, self.up_bw)
+
+
+class AgentHost(object):
+    """The sim's end of one host process"""
+    def __init__(self, config, ids, pieces, agents, seed):
+        """
+        ids, pieces: every peer's id and starting pieces, in peer order
+        agents: [(class_name, peer_id, up_bw, rng_seed)] to run in this host
+        seed: for the host's random module, or None
+        """
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=host_main,
+            args=(child_conn, config, ids, pieces, agents, seed))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.ids = [spec[1] for spec in agents]
+        self.alive = True
+        # What the host has been sent so far
+        self.rounds_sent = 0
+        self.completions_sent = 0
+        self.versions = dict((pid, 0) for pid in ids)
+        self.new_pieces = dict()  # peer_id -> pieces not yet sent
+        # The (round, phase) this host owes an answer for
+        self.waiting = None
+
+    def changes(self, history, available, completions):
+        """What changed since the last message, and mark it as sent"""
+        # The deltas of the host's agents all cover the same rounds
+        rounds = None
+        for pid in self.ids:
+            delta = history.delta(pid, self.rounds_sent)
+            if rounds is None:
+                since = delta.since
+                rounds = [dict() for ds in delta.downloads]
+            for (records, ds, us) in zip(rounds, delta.downloads,
+                                         delta.uploads):
+                records[pid] = ([encode_download(d) for d in ds],
+                                [encode_upload(u) for u in us])
+        self.rounds_sent = history.num_rounds()
+
+        infos = []
+        for (pid, info) in available.iteritems():
+            if info.version != self.versions[pid]:
+                infos.append(encode_info(info))
+                self.versions[pid] = info.version
+
+        new_completions = completions[self.completions_sent:]
+        self.completions_sent = len(completions)
+
+        pieces = self.new_pieces
+        self.new_pieces = dict()
+        return (since, rounds, pieces, infos, new_completions)
+
+    def send(self, round, phase, work, history, available, completions):
+        """work: dict : peer_id -> what to pass to its agent this phase"""
+        if not self.alive:
+            return
+        try:
+            self.conn.send((phase, round,
+                            self.changes(history, available, completions),
+                            work))
+            self.waiting = (round, phase)
+        except (IOError, EOFError), e:
+            self.died(e)
+
+    def receive(self, timeout):
+        """
+        The host's answer for the phase it was last sent: dict : peer_id ->
+        list of encoded Requests or Uploads.  Empty if the host has died
+        or took longer than timeout seconds (None waits forever).
+        """
+        if not self.alive or self.waiting is None:
+            return dict()
+        try:
+            while True:
+                if timeout is not None and not self.conn.poll(timeout):
+                    logging.warning("Agent host for %s didn't decide in "
+                                    "time, using []", ", ".join(self.ids))
+                    return dict()
+                (round, phase, results, errors) = self.conn.recv()
+                # Skip answers to phases that already timed out
+                if (round, phase) == self.waiting:
+                    break
+        except (IOError, EOFError), e:
+            self.died(e)
+            return dict()
+        self.waiting = None
+        for (pid, tb) in sorted(errors.iteritems()):
+            logging.error("%s failed in its agent host, using []:\n%s",
+                          pid, tb)
+        return results
+
+    def died(self, e):
+        logging.error("Agent host for %s died (%r), its agents will do "
+                      "nothing from now on", ", ".join(self.ids), e)
+        self.alive = False
+
+    def stop(self):
+        if self.alive:
+            try:
+                self.conn.send(("stop", None, None, None))
+            except (IOError, EOFError):
+                pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class AgentHosts(object):
+    """Agents spread over several AgentHost processes"""
+    def __init__(self, config, class_names, ids, pieces, up_bws, rng_seeds, n,
+                 seed=None):
+        """
+        Agent i goes to host i % n, and gets random.Random(rng_seeds[i]) as
+        its random stream, just like it would in the sim's process.  If
+        seed is given, host j seeds its random module with (seed, j), for
+        agents that use that.
+        peers: the HostedPeers, in the same order as ids
+        """
+        groups = [[] for j in range(n)]
+        for (i, spec) in enumerate(zip(class_names, ids, up_bws, rng_seeds)):
+            groups[i % n].append(spec)
+        self.hosts = [AgentHost(config, ids, pieces, agents,
+                                None if seed is None else (seed, j))
+                      for (j, agents) in enumerate(groups) if agents]
+
+        host_for = dict()
+        for host in self.hosts:
+            for pid in host.ids:
+                host_for[pid] = host
+        self.peers = [HostedPeer(config.agent_classes[class_name], pid,
+                                 pieces[i], up_bws[i], host_for[pid])
+                      for (i, (class_name, pid))
+                      in enumerate(zip(class_names, ids))]
+
+    def decide(self, round, phase, work, history, available, completions,
+               timeout=None):
+        """
+        Send each host the work for its agents, then wait for them all.
+        phase: "requests" or "uploads"
+        work: dict : peer_id -> None for requests, or the Requests made to
+            the peer for uploads
+        Returns dict : peer_id -> list of Requests or Uploads.  Agents whose
+        host didn't answer get [].
+        """
+        if phase == "uploads":
+            work = dict((pid, [encode_request(r) for r in rs])
+                        for (pid, rs) in work.iteritems())
+        decode = decode_request if phase == "requests" else decode_upload
+        asked = []
+        for host in self.hosts:
+            host_work = dict((pid, work[pid]) for pid in host.ids
+                             if pid in work)
+            if host_work:
+                host.send(round, phase, host_work, history, available,
+                          completions)
+                asked.append(host)
+
+        results = dict()
+        start = time.time()
+        for host in asked:
+            if timeout is not None:
+                left = max(0, start + timeout - time.time())
+            else:
+                left = None
+            for (pid, ts) in host.receive(left).iteritems():
+                results[pid] = [decode(t) for t in ts]
+        for pid in work:
+            results.setdefault(pid, [])
+        return results
+
+    def stop(self):
+        for host in self.hosts:
+            host.stop()
+
+
+def host_main(conn, config, ids, pieces, agents, seed):
+    """
+    The host process: make the agents, then answer the sim's messages
+    until told to stop or the sim goes away.
+    """
+    random.seed(seed)
+    peers = dict()
+    for (class_name, peer_id, up_bw, rng_seed) in agents:
+        i = ids.index(peer_id)
+        peers[peer_id] = config.agent_classes[class_name](
+            config, peer_id, pieces[i], up_bw, random.Random(rng_seed))
+    order = [spec[1] for spec in agents]
+
+    # The host's own copies of what the agents get to see.
+    history = History(ids, dict(), config.history_window,
+                      config.recent_rounds)
+    infos = [PeerInfo(pid, set(j for j in range(config.num_pieces)
+                               if ps[j] == config.blocks_per_piece))
+             for (pid, ps) in zip(ids, pieces)]
+    info_index = dict((pid, i) for (i, pid) in enumerate(ids))
+    piece_counts = [0] * config.num_pieces
+    for info in infos:
+        for piece_id in info.available_pieces:
+            piece_counts[piece_id] += 1
+    piece_completions = []
+    rarity = RarityView(piece_counts, piece_completions)
+    for p in peers.values():
+        p.update_rarity(rarity)
+    # peer_id -> rounds of history given, for agents that get AgentDeltas
+    told = dict()
+
+    def agent_history(p):
+        if not p.history_deltas:
+            return history.peer_history(p.id)
+        since = told.get(p.id, 0)
+        told[p.id] = history.num_rounds()
+        return history.delta(p.id, since)
+
+    no_records = ([], [])
+    last_round = None
+    while True:
+        try:
+            (phase, round, changes, work) = conn.recv()
+        except (EOFError, IOError):
+            break
+        if phase == "stop":
+            break
+
+        (since, rounds, new_pieces, new_infos, new_completions) = changes
+        if round != last_round:
+            # peer_id -> the history its agent gets this round
+            hs = dict()
+            last_round = round
+        # Rounds that fell out of the sim's history window before they
+        # could be sent are played as empty here.
+        while history.num_rounds() < since:
+            history.update(dict((pid, []) for pid in ids),
+                           dict((pid, []) for pid in ids))
+        for records in rounds:
+            dls = dict()
+            ups = dict()
+            for pid in ids:
+                (ds, us) = records.get(pid, no_records)
+                dls[pid] = [decode_download(t) for t in ds]
+                ups[pid] = [decode_upload(t) for t in us]
+            history.update(dls, ups)
+        for (pid, ps) in new_pieces.iteritems():
+            peers[pid].update_pieces(ps)
+        for t in new_infos:
+            info = decode_info(t)
+            infos[info_index[info.id]] = info
+        for (peer_id, piece_id) in new_completions:
+            piece_counts[piece_id] += 1
+            piece_completions.append((peer_id, piece_id))
+
+        results = dict()
+        errors = dict()
+        for pid in order:
+            if pid not in work:
+                continue
+            p = peers[pid]
+            view = PeerView(infos, info_index, pid)
+            if pid not in hs:
+                hs[pid] = agent_history(p)
+            try:
+                if phase == "requests":
+                    p.update_rarity(rarity)
+                    results[pid] = [encode_request(r) for r in
+                                    p.requests(view, hs[pid])]
+                else:
+                    rs = [decode_request(t) for t in work[pid]]
+                    results[pid] = [encode_upload(u) for u in
+                                    p.uploads(rs, view, hs[pid])]
+            except Exception:
+                errors[pid] = traceback.format_exc()
+                results[pid] = []
+        try:
+            conn.send((round, phase, results, errors))
+        except (EOFError, IOError):
+            break
+    conn.close()
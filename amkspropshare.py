@@ -6,7 +6,6 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 import math
 
@@ -40,15 +39,15 @@ class AmksPropShare(Peer):
 
         logging.debug("%s still here. Here are some peers:" % self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
@@ -56,13 +55,15 @@ class AmksPropShare(Peer):
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             isect = av_set.intersection(np_set)
             n = min(self.max_requests, len(isect))
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            for piece_id in random.sample(isect, n):
+            # Sorted, so the pieces only depend on self.rng, not on how
+            # the set happens to be laid out.
+            for piece_id in self.rng.sample(sorted(isect), n):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -114,9 +115,11 @@ class AmksPropShare(Peer):
                 chosen = prop_share_ids.keys()
                 chosen_set = set(chosen)
                 unshared_set = requests_set - chosen_set
-                unshared = list(unshared_set)
+                # Sorted, so the choice below only depends on self.rng
+                unshared = sorted(unshared_set, key=lambda r: (
+                    r.requester_id, r.piece_id, r.start))
                 if len(unshared) > 0:
-                    request = random.choice(unshared)
+                    request = self.rng.choice(unshared)
                     chosen.append(request)
                 free_bw = 1.0 - self.unchoke_portion 
                 bws = []
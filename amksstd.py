@@ -8,7 +8,6 @@
 
 from __future__ import division
 
-import random
 import logging
 
 from messages import Upload, Request
@@ -16,6 +15,9 @@ from util import even_split
 from peer import Peer
 
 class AmksStd(Peer):
+    # Only looks at the last round's downloads
+    history_deltas = True
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -40,39 +42,36 @@ class AmksStd(Peer):
 
         logging.debug("%s still here. Here are some peers:" % self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
         peers.sort(key=lambda p: p.id)
 
-        piece_directory = {}
+        # Which peers have each of the pieces we need.  How rare the
+        # pieces are comes from self.rarity.
         piece_to_peer = {}
         num_requests = {}
 
         for peer in peers:
             num_requests[peer.id] = 0
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             isect = av_set.intersection(np_set)
-            for piece_id in list(isect):
-                if piece_id in piece_directory:
+            for piece_id in sorted(isect):
+                if piece_id in piece_to_peer:
                     piece_to_peer[piece_id].append(peer)
-                    piece_directory[piece_id] += 1
                 else:
                     piece_to_peer[piece_id] = [peer]
-                    piece_directory[piece_id] = 1
 
-        rarest_pieces = []
-        for key, value in sorted(piece_directory.iteritems(), key=lambda (k,v): (v,k)):
-            rarest_pieces.append(key)
+        rarest_pieces = self.rarity.rarest(piece_to_peer)
 
         for piece in rarest_pieces:
             for peer in piece_to_peer[piece]:
@@ -113,17 +112,11 @@ class AmksStd(Peer):
                 request_ids.append(request.requester_id)
 
             if round == 0:
-                random.shuffle(request_ids)
+                self.rng.shuffle(request_ids)
                 chosen = request_ids[:self.unchoke_slots]
             else:
-                download_speed = {}
-                for download in history.downloads[round-1]:
-                    p_id = download.from_id
-                    if p_id not in download_speed:
-                        download_speed[p_id] = download.blocks
-                    else:
-                        download_speed[p_id] += download.blocks
-                
+                download_speed = history.received_last_round()
+
                 for peer in peers:
                     if peer.id not in download_speed:
                         download_speed[peer.id] = 0
@@ -142,7 +135,7 @@ class AmksStd(Peer):
                     index += 1
 
                 # Optimistic unchoking
-                chosen.append(random.choice(request_ids))
+                chosen.append(self.rng.choice(request_ids))
 
                 # Evenly "split" my upload bandwidth among the one chosen requester
                 bws = even_split(self.up_bw, len(chosen))
@@ -8,7 +8,6 @@
 
 from __future__ import division
 
-import random
 import logging
 
 from messages import Upload, Request
@@ -18,6 +17,11 @@ from collections import deque
 import operator 
 
 class AmksTourney(Peer):
+    # Sets up its rates in round 0 and discounts its cap every round
+    needs_every_round = True
+    # Only looks at the last round's downloads
+    history_deltas = True
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -53,50 +57,49 @@ class AmksTourney(Peer):
 
         logging.debug("%s still here. Here are some peers:" % self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = [] 
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
         peers.sort(key=lambda p: p.id)
 
-        piece_directory = {}
+        # Which peers have each of the pieces we need.  How rare the
+        # pieces are comes from self.rarity.
         piece_to_peer = {}
         num_requests = {}
 
         for peer in peers:
             num_requests[peer.id] = 0
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             isect = av_set.intersection(np_set)
-            for piece_id in list(isect):
-                if piece_id in piece_directory:
+            for piece_id in sorted(isect):
+                if piece_id in piece_to_peer:
                     piece_to_peer[piece_id].append(peer)
-                    piece_directory[piece_id] += 1
                 else:
                     piece_to_peer[piece_id] = [peer]
-                    piece_directory[piece_id] = 1
 
-        while piece_directory:
-            most_rare_value = min(piece_directory.values())
-            rare_pieces = [k for k in piece_directory if piece_directory[k] == most_rare_value]
-            rand_piece = random.choice(rare_pieces)
+        while piece_to_peer:
+            most_rare_value = min(self.rarity[k] for k in piece_to_peer)
+            rare_pieces = [k for k in piece_to_peer if self.rarity[k] == most_rare_value]
+            rand_piece = self.rng.choice(rare_pieces)
             rarest_list = piece_to_peer[rand_piece]
             while rarest_list != []:
-                peer = random.choice(rarest_list)
+                peer = self.rng.choice(rarest_list)
                 if num_requests[peer.id] < self.max_requests:
                     start_block = self.pieces[rand_piece]
                     r = Request(self.id, peer.id, rand_piece, start_block)
                     requests.append(r)
                     num_requests[peer.id] += 1
                 rarest_list.remove(peer)
-            piece_directory.pop(rand_piece)
+            piece_to_peer.pop(rand_piece)
             
         return requests
 
@@ -153,7 +156,7 @@ class AmksTourney(Peer):
             # Do not upload to peers that are requesting the most requested piece
             max_piece = max(requested_pieces.iteritems(), key=operator.itemgetter(1))[0]
             peers_to_avoid = requesting_peers[max_piece]
-            random_peer = random.choice(peers_to_avoid)
+            random_peer = self.rng.choice(peers_to_avoid)
             peers_to_avoid.remove(random_peer)
 
             # Order peers by decreasing reciprocation likelihood ratio
@@ -164,7 +167,7 @@ class AmksTourney(Peer):
             while total_up < self.cap:
                 greatest_ratio = max(self.ratios.values())
                 greatest_list = [key for key,value in self.ratios.items() if value == greatest_ratio]
-                choice = random.choice(greatest_list)
+                choice = self.rng.choice(greatest_list)
                 if (total_up + self.upload_rates[choice]) < self.cap:
                     if choice in request_ids and choice not in peers_to_avoid:
                         chosen.append(choice)
@@ -173,14 +176,8 @@ class AmksTourney(Peer):
                 total_up += self.upload_rates[choice]
 
             # Update which peers have unchoked this agent
-            downloads_last = {}
+            downloads_last = history.received_last_round()
             if round != 0:
-                for download in history.downloads[round-1]:
-                    if download.from_id not in downloads_last:
-                        downloads_last[download.from_id] = download.blocks
-                    else:
-                        downloads_last[download.from_id] += download.blocks
-
                 for peer in peers:
                     if peer.id in downloads_last:
                         self.unchoked[peer.id] += 1
@@ -8,7 +8,6 @@
 
 from __future__ import division
 
-import random
 import logging
 
 from messages import Upload, Request
@@ -17,6 +16,11 @@ from peer import Peer
 from collections import deque
 
 class AmksTyrant(Peer):
+    # Sets up its rates in round 0 and updates them every round
+    needs_every_round = True
+    # Only looks at the last round's downloads
+    history_deltas = True
+
     def post_init(self):
         print "post_init(): %s here!" % self.id
         self.dummy_state = dict()
@@ -51,39 +55,36 @@ class AmksTyrant(Peer):
 
         logging.debug("%s still here. Here are some peers:" % self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = [] 
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
         peers.sort(key=lambda p: p.id)
 
-        piece_directory = {}
+        # Which peers have each of the pieces we need.  How rare the
+        # pieces are comes from self.rarity.
         piece_to_peer = {}
         num_requests = {}
 
         for peer in peers:
             num_requests[peer.id] = 0
-            av_set = set(peer.available_pieces)
+            av_set = peer.available_pieces
             isect = av_set.intersection(np_set)
-            for piece_id in list(isect):
-                if piece_id in piece_directory:
+            for piece_id in sorted(isect):
+                if piece_id in piece_to_peer:
                     piece_to_peer[piece_id].append(peer)
-                    piece_directory[piece_id] += 1
                 else:
                     piece_to_peer[piece_id] = [peer]
-                    piece_directory[piece_id] = 1
 
-        rarest_pieces = []
-        for key, value in sorted(piece_directory.iteritems(), key=lambda (k,v): (v,k)):
-            rarest_pieces.append(key)
+        rarest_pieces = self.rarity.rarest(piece_to_peer)
 
         for piece in rarest_pieces:
             for peer in piece_to_peer[piece]:
@@ -141,7 +142,7 @@ class AmksTyrant(Peer):
             while total_up < self.cap:
                 greatest_ratio = max(self.ratios.values())
                 greatest_list = [key for key,value in self.ratios.items() if value == greatest_ratio]
-                choice = random.choice(greatest_list)
+                choice = self.rng.choice(greatest_list)
                 if (total_up + self.upload_rates[choice]) < self.cap:
                     if choice in request_ids:
                         chosen.append(choice)
@@ -150,14 +151,8 @@ class AmksTyrant(Peer):
                 total_up += self.upload_rates[choice]
 
             # Update which peers have unchoked this agent
-            downloads_last = {}
+            downloads_last = history.received_last_round()
             if round != 0:
-                for download in history.downloads[round-1]:
-                    if download.from_id not in downloads_last:
-                        downloads_last[download.from_id] = download.blocks
-                    else:
-                        downloads_last[download.from_id] += download.blocks
-
                 for peer in peers:
                     if peer.id in downloads_last:
                         self.unchoked[peer.id] += 1
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the simulator.  Takes the same options and agent list as
+sim.py, after the name of the benchmark to run:
+
+  bench.py messages [sim options] PeerClass1[,count] ...
+
+messages: memory used by one run's messages if kept as objects, with
+  the current (__slots__) message classes vs. plain classes with a
+  __dict__, as they used to be, and by the History's columns.
+
+rounds: time per round of a run at --loglevel ("lazy"), vs. the same
+  run with --quiet, and with every log message built whatever the level
+  ("eager", the way the sim and agents logged before).  Each is run once
+  to warm up, then ROUNDS_REPEATS times; the median and best are shown.
+  Log output is thrown away, so only the cost of building the messages
+  is measured.
+
+stats: time to compute each of the Stats of one run's history, with
+  Stats vs. ArrayStats (needs numpy).
+"""
+
+import os
+import sys
+import time
+import logging
+
+import sim
+from messages import Upload, Request, Download, PeerInfo
+from stats import Stats, ArrayStats
+from util import median
+
+
+ROUNDS_REPEATS = 5
+
+
+class Plain:
+    """An old-style instance with a __dict__, like the messages used to be"""
+    pass
+
+
+def as_plain(msg):
+    """Copy of a message as a Plain object with the same attributes"""
+    p = Plain()
+    for name in msg.__slots__:
+        setattr(p, name, getattr(msg, name))
+    return p
+
+
+def object_size(o):
+    """Bytes used by o and its __dict__, if it has one.  Attribute values
+    (peer ids, small ints) are shared, so they aren't counted."""
+    size = sys.getsizeof(o)
+    if hasattr(o, '__dict__'):
+        size += sys.getsizeof(o.__dict__)
+    return size
+
+
+def bench_messages(config):
+    samples = [Upload("Peer0", "Peer1", 4),
+               Request("Peer0", "Peer1", 2, 0),
+               Download("Peer0", "Peer1", 2, 4),
+               PeerInfo("Peer0", set())]
+
+    print "Per-object size in bytes: before  after"
+    for msg in samples:
+        print "  %-10s %6d %6d" % (msg.__class__.__name__,
+                                   object_size(as_plain(msg)),
+                                   object_size(msg))
+
+    s = sim.Sim(config)
+    s.peer_ids = s.make_peer_ids()
+    history = s.run_sim_once(config.seed)
+
+    count = 0
+    before = 0
+    after = 0
+    for table in (history.downloads, history.uploads):
+        for rounds in table.values():
+            for msgs in rounds:
+                for msg in msgs:
+                    count += 1
+                    before += object_size(as_plain(msg))
+                    after += object_size(msg)
+
+    print "History of %d rounds: %d messages" % (history.last_round() + 1,
+                                                 count)
+    print "  before: %d bytes" % before
+    print "  after:  %d bytes" % after
+
+    columns = [history.dl_round, history.dl_from, history.dl_to,
+               history.dl_piece, history.dl_blocks, history.dl_offsets,
+               history.ul_round, history.ul_from, history.ul_to,
+               history.ul_bw, history.ul_offsets]
+    print "  History columns: %d bytes" % sum(len(c) * c.itemsize
+                                               for c in columns)
+
+
+class FormatBelow(logging.Handler):
+    """
+    Builds the messages below level that it gets, and throws them away.
+    The ones at level or above get built by the output handler anyway.
+    """
+    def __init__(self, level):
+        logging.Handler.__init__(self)
+        self.below = level
+
+    def emit(self, record):
+        if record.levelno < self.below:
+            record.getMessage()
+
+
+def bench_rounds(config):
+    level = logging.root.level
+    format_below = FormatBelow(level)
+
+    def time_run(mode):
+        """ms per round of one run, and the number of rounds"""
+        config.add("quiet", mode == "quiet")
+        if mode == "eager":
+            # Every message gets made, as if its level were enabled; the
+            # output handler still only writes the ones at level.
+            logging.root.setLevel(logging.DEBUG)
+            logging.root.addHandler(format_below)
+        try:
+            s = sim.Sim(config)
+            s.peer_ids = s.make_peer_ids()
+            start = time.time()
+            history = s.run_sim_once(config.seed)
+            secs = time.time() - start
+        finally:
+            logging.root.setLevel(level)
+            logging.root.removeHandler(format_below)
+        rounds = history.last_round() + 1
+        return (1000 * secs / rounds, rounds)
+
+    modes = ("eager", "lazy", "quiet")
+    for mode in modes:
+        time_run(mode)
+    times = dict((mode, []) for mode in modes)
+    for i in range(ROUNDS_REPEATS):
+        # Take turns, so that drift in the machine's speed hits every mode
+        for mode in modes:
+            (ms, rounds) = time_run(mode)
+            times[mode].append(ms)
+
+    print "Time per round (ms) at log level %s, %d rounds, %d runs each" % (
+        logging.getLevelName(level), rounds, ROUNDS_REPEATS)
+    print "           median     best"
+    for mode in modes:
+        print "  %-6s %9.3f %8.3f" % (mode, median(times[mode]),
+                                      min(times[mode]))
+
+
+def bench_stats(config):
+    if sim.numpy is None:
+        print "The stats benchmark needs numpy"
+        sys.exit(1)
+    config.add("quiet", True)
+    s = sim.Sim(config)
+    s.peer_ids = s.make_peer_ids()
+    history = s.run_sim_once(config.seed)
+
+    print "Time to compute (ms) for %d peers, %d rounds: Stats  ArrayStats" % (
+        len(s.peer_ids), history.num_rounds())
+    for name in ("uploaded_blocks", "downloaded_blocks", "throughput",
+                 "completion_cdf"):
+        times = []
+        for backend in (Stats, ArrayStats):
+            start = time.time()
+            getattr(backend, name)(s.peer_ids, history)
+            times.append(1000 * (time.time() - start))
+        print "  %-18s %8.3f %8.3f" % ((name,) + tuple(times))
+
+
+BENCHMARKS = {"messages": bench_messages,
+              "rounds": bench_rounds,
+              "stats": bench_stats}
+
+
+def main(args):
+    if len(args) < 2 or args[1] not in BENCHMARKS:
+        print "Usage: %s {%s} [sim options] PeerClass1[,count] ..." % (
+            args[0], "|".join(sorted(BENCHMARKS)))
+        sys.exit(1)
+
+    (options, agents_to_run) = sim.parse_args(args[1:])
+    if options.seed is None:
+        options.seed = 0
+    # Format log messages at the requested level, but don't print them.
+    level = getattr(logging, options.loglevel.upper())
+    root_logger = logging.getLogger('')
+    root_logger.setLevel(level)
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setLevel(level)
+    root_logger.addHandler(handler)
+
+    BENCHMARKS[args[1]](sim.make_config(options, agents_to_run))
+
+if __name__ == "__main__":
+    main(sys.argv)
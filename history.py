@@ -2,6 +2,14 @@
 
 import copy
 import pprint
+from array import array
+from collections import deque
+
+from messages import Upload, Download
+from util import whole_to_int
+
+# What uploads to anything that isn't a peer are recorded as going to
+NOT_A_PEER = "<not a peer>"
 
 
 class AgentHistory:
@@ -14,14 +22,31 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    The received_* methods give the blocks this agent downloaded from each
+    peer, without going through the downloads.
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, received=None):
         """
         Pull out just the info for peer_id.
+        received: the Received counts for peer_id
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        self.received = received
+
+    def received_last_round(self):
+        """dict : peer_id -> blocks downloaded from that peer last round"""
+        return dict(self.received.last)
+
+    def received_recent(self):
+        """dict : peer_id -> blocks downloaded from that peer in the last
+        few rounds (History.recent_rounds of them)"""
+        return dict(self.received.recent)
+
+    def received_total(self):
+        """dict : peer_id -> blocks downloaded from that peer so far"""
+        return dict(self.received.total)
 
     def last_round(self):
         return len(self.downloads)-1
@@ -36,9 +61,129 @@ class AgentHistory:
             pprint.pformat(self.uploads))
 
 
+class AgentDelta(AgentHistory):
+    """
+    What happened to a single peer in the rounds since it last got its
+    history, for agents that keep their own (see Peer.history_deltas).
+
+    delta.since: the first round in the delta
+    delta.downloads, delta.uploads: as for AgentHistory, but only one
+        sublist for each round from since on.
+
+    The received_* methods and current_round() are the same as for
+    AgentHistory.
+    """
+    def __init__(self, peer_id, since, downloads, uploads, received=None):
+        AgentHistory.__init__(self, peer_id, downloads, uploads, received)
+        self.since = since
+
+    def last_round(self):
+        return self.since + len(self.downloads) - 1
+
+    def current_round(self):
+        return self.since + len(self.downloads)
+
+    def __repr__(self):
+        return "AgentDelta(since=%d, downloads=%s, uploads=%s)" % (
+            self.since,
+            pprint.pformat(self.downloads),
+            pprint.pformat(self.uploads))
+
+
+class Received(object):
+    """
+    Running counts of the blocks one peer has downloaded from each other
+    peer.  Each is a dict : from_id -> blocks, with no entries for peers
+    it didn't download from.
+    last: in the last round
+    recent: in the last n rounds
+    total: in all rounds
+    """
+    def __init__(self, n):
+        self.last = dict()
+        self.recent = dict()
+        self.total = dict()
+        self.rounds = deque()  # the last n rounds' dicts, oldest first
+        self.n = n
+        # from_id -> number of rounds in self.rounds that it's in
+        self.recent_rounds = dict()
+
+    def add_round(self, received):
+        """received: dict : from_id -> blocks for the round just played"""
+        self.last = received
+        for (from_id, blocks) in received.iteritems():
+            self.total[from_id] = self.total.get(from_id, 0) + blocks
+            self.recent[from_id] = self.recent.get(from_id, 0) + blocks
+            self.recent_rounds[from_id] = self.recent_rounds.get(from_id, 0) + 1
+        self.rounds.append(received)
+        if len(self.rounds) > self.n:
+            for (from_id, blocks) in self.rounds.popleft().iteritems():
+                self.recent_rounds[from_id] -= 1
+                if self.recent_rounds[from_id] == 0:
+                    del self.recent_rounds[from_id]
+                    del self.recent[from_id]
+                else:
+                    self.recent[from_id] -= blocks
+
+
+class PeerRounds(object):
+    """
+    Read-only list of rounds of one peer's downloads or uploads in a
+    History.  Element r is a list of the Download (or Upload) objects for
+    round r, made from the History's columns when asked for.
+
+    The length is always the number of rounds played.  If the history
+    only keeps a window of recent rounds, asking for an older round
+    raises IndexError, and iterating starts at the oldest round kept.
+    Slices leave out the rounds that aren't kept, so the last few rounds
+    are always history.downloads[-k:]:
+
+    >>> h = History(["a", "b"], dict(), window=2)
+    >>> for r in range(4):
+    ...     h.update(dict(a=[Download("b", "a", r, 1)], b=[]),
+    ...              dict(a=[], b=[]))
+    >>> [[d.piece for d in ds] for ds in h.downloads["a"][-3:]]
+    [[2], [3]]
+    >>> h.downloads["a"][1]
+    Traceback (most recent call last):
+    ...
+    IndexError: Round 1 is no longer kept in history (window of 2 rounds)
+    """
+    def __init__(self, history, records, peer_index):
+        """records: function (round, peer_index) -> [messages]"""
+        self.history = history
+        self.records = records
+        self.peer_index = peer_index
+
+    def __len__(self):
+        return self.history.num_rounds()
+
+    def __getitem__(self, r):
+        rounds = self.history.num_rounds()
+        if isinstance(r, slice):
+            first = self.history.first_round()
+            return [self.records(i, self.peer_index)
+                    for i in range(*r.indices(rounds)) if i >= first]
+        if r < 0:
+            r += rounds
+        if r < 0 or r >= rounds:
+            raise IndexError("No round %s in history" % r)
+        if r < self.history.first_round():
+            raise IndexError("Round %s is no longer kept in history "
+                             "(window of %d rounds)" % (r, self.history.window))
+        return self.records(r, self.peer_index)
+
+    def __iter__(self):
+        for r in range(self.history.first_round(), self.history.num_rounds()):
+            yield self.records(r, self.peer_index)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+    def __init__(self, peer_ids, upload_rates, window=0, recent_rounds=3):
         """
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
@@ -47,13 +192,80 @@ class History:
                    
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
+
+        The messages aren't kept around.  Their fields are stored in
+        parallel arrays (dl_* for downloads, ul_* for uploads), with peer
+        ids replaced by their index in self.ids.  Records are kept in
+        order of round, then of peer, and dl_offsets[r * n + i] is where
+        the downloads to the i'th peer in round r start (n is the number
+        of peers).  ul_offsets is the same for uploads from the peer.
+        downloads and uploads are views that make message objects from
+        the arrays on demand.
+
+        window: if not 0, only the last window rounds are kept.  Running
+        totals cover the whole sim:
+        blocks_downloaded: dict : peer_id -> blocks downloaded by the peer
+        blocks_uploaded: dict : peer_id -> blocks downloaded from the peer
+        received: dict : peer_id -> Received counts for the peer, whose
+            recent counts cover the last recent_rounds rounds
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
+        self.window = window
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.rounds = 0
+        # The round that the start of the columns holds
+        self.stored_from = 0
+
+        self.blocks_downloaded = dict((pid, 0) for pid in peer_ids)
+        self.blocks_uploaded = dict((pid, 0) for pid in peer_ids)
+        self.recent_rounds = recent_rounds
+        self.received = dict((pid, Received(recent_rounds))
+                             for pid in peer_ids)
+
+        # The peers come first.  If an agent sends an upload to anything
+        # else, NOT_A_PEER gets added on the end.
+        self.ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+
+        self.dl_round = array('i')
+        self.dl_from = array('i')
+        self.dl_to = array('i')
+        self.dl_piece = array('i')
+        self.dl_blocks = array('d')
+        self.dl_offsets = array('I', [0])
+
+        self.ul_round = array('i')
+        self.ul_from = array('i')
+        self.ul_to = array('i')
+        self.ul_bw = array('d')
+        self.ul_offsets = array('I', [0])
+
+        self.dl_columns = [self.dl_round, self.dl_from, self.dl_to,
+                           self.dl_piece, self.dl_blocks]
+        self.ul_columns = [self.ul_round, self.ul_from, self.ul_to,
+                           self.ul_bw]
+
+        self.downloads = dict(
+            (pid, PeerRounds(self, self.downloads_for_round, i))
+            for (i, pid) in enumerate(peer_ids))
+        self.uploads = dict(
+            (pid, PeerRounds(self, self.uploads_for_round, i))
+            for (i, pid) in enumerate(peer_ids))
+
+    def id_index(self, peer_id):
+        """
+        peer_id's index in self.ids.  Ids that aren't peers all get the
+        index of NOT_A_PEER, so that agents uploading to other things
+        can't make self.ids grow without bound.
+        """
+        if peer_id in self.index:
+            return self.index[peer_id]
+        if NOT_A_PEER not in self.index:
+            self.index[NOT_A_PEER] = len(self.ids)
+            self.ids.append(NOT_A_PEER)
+        return self.index[NOT_A_PEER]
 
     def update(self, dls, ups):
         """
@@ -62,9 +274,78 @@ class History:
 
         append these downloads to to the history
         """
+        r = self.num_rounds()
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+            received = dict()
+            for d in dls[pid]:
+                self.dl_round.append(r)
+                self.dl_from.append(self.id_index(d.from_id))
+                self.dl_to.append(self.id_index(d.to_id))
+                self.dl_piece.append(d.piece)
+                self.dl_blocks.append(d.blocks)
+                self.blocks_downloaded[pid] += d.blocks
+                self.blocks_uploaded[d.from_id] += d.blocks
+                received[d.from_id] = received.get(d.from_id, 0) + d.blocks
+            self.dl_offsets.append(len(self.dl_round))
+            self.received[pid].add_round(received)
+
+            for u in ups[pid]:
+                self.ul_round.append(r)
+                self.ul_from.append(self.id_index(u.from_id))
+                self.ul_to.append(self.id_index(u.to_id))
+                self.ul_bw.append(u.bw)
+            self.ul_offsets.append(len(self.ul_round))
+
+        self.rounds += 1
+        if self.window:
+            self.trim()
+
+    def trim(self):
+        """
+        Drop the stored rounds that are out of the window.  Waits until a
+        whole window's worth have expired, so that each record only gets
+        moved a couple of times.
+        """
+        expired = self.first_round() - self.stored_from
+        if expired < self.window:
+            return
+        n = len(self.peer_ids)
+        for (columns, offsets) in ((self.dl_columns, self.dl_offsets),
+                                   (self.ul_columns, self.ul_offsets)):
+            cut = offsets[expired * n]
+            for c in columns:
+                del c[:cut]
+            del offsets[:expired * n]
+            for j in xrange(len(offsets)):
+                offsets[j] -= cut
+        self.stored_from += expired
+
+    def num_rounds(self):
+        return self.rounds
+
+    def first_round(self):
+        """index of the oldest round kept"""
+        if self.window:
+            return max(0, self.rounds - self.window)
+        return 0
+
+    def downloads_for_round(self, r, i):
+        """[Download] to the i'th peer in round r"""
+        n = len(self.peer_ids)
+        ids = self.ids
+        j = (r - self.stored_from) * n + i
+        return [Download(ids[self.dl_from[k]], ids[self.dl_to[k]],
+                         self.dl_piece[k], whole_to_int(self.dl_blocks[k]))
+                for k in xrange(self.dl_offsets[j], self.dl_offsets[j + 1])]
+
+    def uploads_for_round(self, r, i):
+        """[Upload] from the i'th peer in round r"""
+        n = len(self.peer_ids)
+        ids = self.ids
+        j = (r - self.stored_from) * n + i
+        return [Upload(ids[self.ul_from[k]], ids[self.ul_to[k]],
+                       whole_to_int(self.ul_bw[k]))
+                for k in xrange(self.ul_offsets[j], self.ul_offsets[j + 1])]
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -72,27 +353,41 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id],
+                            self.received[peer_id])
+
+    def delta(self, peer_id, since):
+        """
+        AgentDelta of peer_id's downloads and uploads from round since on.
+        Rounds that are out of the window are left out, so the delta's
+        since can be later than asked for.
+        """
+        since = max(since, self.first_round())
+        i = self.index[peer_id]
+        rounds = range(since, self.num_rounds())
+        return AgentDelta(peer_id, since,
+                          [self.downloads_for_round(r, i) for r in rounds],
+                          [self.uploads_for_round(r, i) for r in rounds],
+                          self.received[peer_id])
 
     def last_round(self):
         """index of the last completed round"""
-        p = self.peer_ids[0]
-        return len(self.downloads[p])-1
+        return self.num_rounds()-1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        s = ["\nRound %s:\n" % r]
         for peer_id in self.peer_ids:
             ds = self.downloads[peer_id][r]
             stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
                 peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            s.extend(map(stringify, ds))
+        return "".join(s)
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        s = ["History\n"]
+        for r in range(self.first_round(), self.last_round()+1):
+            s.append(self.pretty_for_round(r))
+        return "".join(s)
 
     def __repr__(self):
         return """History(
@@ -1,6 +1,11 @@
 #!/usr/bin/python
 
-class Upload:
+# Lots of these get made and kept around in the History, so they use
+# __slots__ to avoid carrying a __dict__ each.
+
+class Upload(object):
+    __slots__ = ('from_id', 'to_id', 'bw')
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -10,7 +15,9 @@ class Upload:
         return "Upload(from_id = %s, to_id=%s, bw=%d)" % (
             self.from_id, self.to_id, self.bw)
 
-class Request:
+class Request(object):
+    __slots__ = ('requester_id', 'peer_id', 'piece_id', 'start')
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -21,10 +28,12 @@ class Request:
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
 
-class Download:
+class Download(object):
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ('from_id', 'to_id', 'piece', 'blocks')
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -35,15 +44,175 @@ class Download:
         return "Download(from_id=%s, to_id=%s, piece=%d, blocks=%d)" % (
             self.from_id, self.to_id, self.piece, self.blocks)
             
-class PeerInfo:
+class PeerInfo(object):
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available_pieces is a frozenset, shared by everyone who looks at this
+    peer, and PeerInfo objects can't be changed.  version goes up each
+    time the peer gets new pieces, so an agent can tell if the set is the
+    same one it saw before.
     """
-    def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+    __slots__ = ('id', 'available_pieces', 'version')
+
+    def __init__(self, id, available, version=0):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'available_pieces', frozenset(available))
+        object.__setattr__(self, 'version', version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PeerInfo can't be changed")
+
+    def __reduce__(self):
+        return (PeerInfo, (self.id, self.available_pieces, self.version))
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+class PeerView(object):
+    """
+    What an agent gets as its list of peers: the PeerInfo for every peer
+    except itself.  Looks like a list, but shares the sim's list of
+    PeerInfo for the round instead of copying it, and skips over the
+    agent's own entry.
+
+    Anything that changes the list (sort, shuffle, append, ...) is done on
+    the agent's own copy, made the first time it's needed, so agents
+    can't change what other agents see.
+
+    >>> infos = [PeerInfo(pid, []) for pid in ["a", "b", "c", "d"]]
+    >>> index = dict((p.id, i) for (i, p) in enumerate(infos))
+    >>> peers = PeerView(infos, index, "b")
+    >>> (len(peers), [p.id for p in peers])
+    (3, ['a', 'c', 'd'])
+    >>> peers.remove(infos[0])
+    >>> del peers[0]
+    >>> (len(peers), [p.id for p in peers], peers.index(infos[3]))
+    (1, ['d'], 0)
+    >>> while peers: x = peers.pop()
+    >>> (len(peers), [] + peers)
+    (0, [])
+    >>> [p.id for p in PeerView(infos, index, "a")]
+    ['b', 'c', 'd']
+    """
+    def __init__(self, infos, index, hidden_id):
+        """
+        infos: [PeerInfo] for all the peers, shared
+        index: dict : peer_id -> position in infos
+        hidden_id: id of the peer to leave out
+        """
+        self._infos = infos
+        self._index = index
+        self._hidden = index[hidden_id]
+        self._own = None
+
+    def _own_list(self):
+        if self._own is None:
+            h = self._hidden
+            self._own = self._infos[:h] + self._infos[h+1:]
+        return self._own
+
+    def by_id(self, peer_id):
+        """The PeerInfo for peer_id.  KeyError if it isn't in the view."""
+        i = self._index[peer_id]
+        if i == self._hidden:
+            raise KeyError(peer_id)
+        return self._infos[i]
+
+    def __len__(self):
+        if self._own is not None:
+            return len(self._own)
+        return len(self._infos) - 1
+
+    def __getitem__(self, i):
+        if self._own is not None or isinstance(i, slice):
+            return self._own_list()[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("PeerView index out of range")
+        if i >= self._hidden:
+            i += 1
+        return self._infos[i]
+
+    def __iter__(self):
+        if self._own is not None:
+            return iter(self._own)
+        return (p for (i, p) in enumerate(self._infos) if i != self._hidden)
+
+    def __contains__(self, p):
+        return p in iter(self)
+
+    def __setitem__(self, i, p):
+        self._own_list()[i] = p
+
+    def __delitem__(self, i):
+        del self._own_list()[i]
+
+    def __getattr__(self, name):
+        # Other list methods (sort, reverse, append, index, ...)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._own_list(), name)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class RarityView(object):
+    """
+    How many peers have each piece available, kept up to date by the sim.
+    rarity[piece_id] is the number of peers (the agent included) with that
+    piece.  Read-only: agents can look, but not change the counts.
+
+    completions() gives the (peer_id, piece_id) of every piece completed
+    during the sim, in order, so that agents that keep their own
+    structures (see picker.py) can catch up on what changed since they
+    last looked instead of going through all the counts.
+    """
+    def __init__(self, counts, completions):
+        """counts: the sim's list of counts, one for each piece
+        completions: the sim's list of (peer_id, piece_id) completions"""
+        self._counts = counts
+        self._completions = completions
+
+    def __getitem__(self, piece_id):
+        return self._counts[piece_id]
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def counts(self):
+        """Tuple of the counts, one for each piece"""
+        return tuple(self._counts)
+
+    def completions(self, start=0):
+        """Tuple of the completions, from the start'th one on"""
+        return tuple(self._completions[start:])
+
+    def num_completions(self):
+        return len(self._completions)
+
+    def rarest(self, piece_ids):
+        """piece_ids in order of rarity, rarest first, ties by piece id"""
+        return sorted(piece_ids, key=lambda i: (self._counts[i], i))
+
+    def __repr__(self):
+        return "RarityView(%s)" % self._counts
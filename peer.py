@@ -5,18 +5,44 @@ from messages import Upload, Request
 from util import even_split
 
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    # With --scheduler active, the sim only calls requests() while the peer
+    # still needs pieces, and uploads() when someone has asked it for
+    # something.  Agents that need to be called every round anyway (e.g. to
+    # keep per-round state up to date) should set this to True.
+    needs_every_round = False
+    # With --decisions threads, the sim calls requests() and uploads() of
+    # agents that set this to True at the same time, on separate threads,
+    # e.g. for agents that wait on a planner or an external bot.  They must
+    # only change their own state, and not use the shared random module,
+    # or runs won't be reproducible.
+    concurrent = False
+    # Agents that set this to True get an AgentDelta as their history: just
+    # the rounds since they were last called, instead of all of them.
+    # Cheaper for agents that only look at recent rounds, or keep their
+    # own record.
+    history_deltas = False
+
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
+        """rng: this agent's own random.Random, so that what it draws
+        doesn't depend on the other agents.  Agents should use self.rng
+        instead of the random module."""
         self.conf = config
         self.id = id
         self.pieces = init_pieces[:]
         # bandwidth measured in blocks-per-time-period
         self.up_bw = up_bandwidth
+        if rng is None:
+            rng = random
+        self.rng = rng
 
         # This is an upper bound on the number of requests to send to
         # each peer -- they can't possibly handle more than this in one round
         self.max_requests = self.conf.max_up_bw / self.conf.blocks_per_piece + 1
         self.max_requests = min(self.max_requests, self.conf.num_pieces)
 
+        # RarityView of how many peers have each piece.  Set by the sim.
+        self.rarity = None
+
         self.post_init()
 
     def __repr__(self):
@@ -31,6 +57,13 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def update_rarity(self, rarity):
+        """
+        Called by the sim before requests() with a RarityView of how many
+        peers have each piece.
+        """
+        self.rarity = rarity
+
     def requests(self, peers, history):
         return []
 
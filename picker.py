@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# Piece pickers: reusable ways for an agent to decide which pieces to
+# request, and from whom.  Keep one picker per agent (make it in
+# post_init) and call it from requests():
+#
+#     def post_init(self):
+#         self.picker = RarestFirst(rng=self.rng)
+#
+#     def requests(self, peers, history):
+#         return self.picker.requests(self, peers)
+#
+# The pickers keep a PieceQueue of the pieces the agent still needs,
+# ordered by rarity, and bring it up to date each round from the
+# completions in the agent's RarityView, so they don't need to recount
+# or re-sort every piece.
+
+import bisect
+import random
+
+from messages import Request
+
+
+class PieceQueue:
+    """
+    Bucket queue of piece ids by rarity: buckets[c] is the sorted list of
+    pieces that c peers have.  Changing a piece's count moves it to its
+    new bucket with a binary search, and going through the pieces rarest
+    first costs O(pieces + highest count), with no sorting.
+    """
+    def __init__(self):
+        self.buckets = []
+        self.counts = dict()  # piece_id -> count
+        self.pieces = set()   # the piece ids in the queue
+
+    def take_out(self, piece_id):
+        bucket = self.buckets[self.counts.pop(piece_id)]
+        del bucket[bisect.bisect_left(bucket, piece_id)]
+        self.pieces.discard(piece_id)
+
+    def set(self, piece_id, count):
+        """Add piece_id with this count, or move it if it's already in"""
+        if piece_id in self.counts:
+            self.take_out(piece_id)
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bisect.insort(self.buckets[count], piece_id)
+        self.counts[piece_id] = count
+        self.pieces.add(piece_id)
+
+    def increment(self, piece_id):
+        """One more peer has piece_id.  Ignored if it isn't in the queue."""
+        if piece_id in self.counts:
+            self.set(piece_id, self.counts[piece_id] + 1)
+
+    def remove(self, piece_id):
+        if piece_id in self.counts:
+            self.take_out(piece_id)
+
+    def __contains__(self, piece_id):
+        return piece_id in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def rarest_first(self):
+        """Generator of the pieces, rarest first, ties by piece id"""
+        for bucket in self.buckets:
+            for piece_id in bucket:
+                yield piece_id
+
+
+class RarestFirst(object):
+    """
+    Ask for the rarest pieces first.  Each piece is asked for from every
+    peer that has it, but no more than agent.max_requests requests go to
+    any one peer.
+    """
+    def __init__(self, rng=random):
+        """rng: where to get random numbers (anything with the interface
+        of the random module)"""
+        self.rng = rng
+        self.queue = None
+        # How many of agent.rarity's completions the queue has seen
+        self.seen = 0
+
+    def sync(self, agent):
+        """Bring the queue up to date with the agent's pieces and rarity"""
+        rarity = agent.rarity
+        if self.queue is None:
+            self.queue = PieceQueue()
+            bpp = agent.conf.blocks_per_piece
+            for piece_id in range(len(agent.pieces)):
+                if agent.pieces[piece_id] < bpp:
+                    self.queue.set(piece_id, rarity[piece_id])
+            self.seen = rarity.num_completions()
+        else:
+            new = rarity.completions(self.seen)
+            for (peer_id, piece_id) in new:
+                if peer_id == agent.id:
+                    self.queue.remove(piece_id)
+                else:
+                    self.queue.increment(piece_id)
+            self.seen += len(new)
+
+    def needed(self, agent):
+        """
+        Set of the piece ids the agent still needs.  That's what's in the
+        queue once it's synced, so this is the queue's own set: don't
+        change it.
+        """
+        return self.queue.pieces
+
+    def order(self, agent, holders):
+        """
+        holders: dict : piece_id -> [PeerInfo of the peers that have it],
+        for the needed pieces that some peer has.
+        Returns those piece ids, in the order to ask for them.
+        """
+        return [i for i in self.queue.rarest_first() if i in holders]
+
+    def limit(self, agent, needed):
+        """Most requests to send to any one peer"""
+        return agent.max_requests
+
+    def requests(self, agent, peers):
+        """The list of Requests for agent to make this round"""
+        self.sync(agent)
+        needed = self.needed(agent)
+
+        holders = dict()
+        for peer in peers:
+            for piece_id in peer.available_pieces.intersection(needed):
+                holders.setdefault(piece_id, []).append(peer)
+
+        limit = self.limit(agent, needed)
+        num_requests = dict()
+        requests = []
+        for piece_id in self.order(agent, holders):
+            for peer in holders[piece_id]:
+                if num_requests.get(peer.id, 0) < limit:
+                    requests.append(Request(agent.id, peer.id, piece_id,
+                                            agent.pieces[piece_id]))
+                    num_requests[peer.id] = num_requests.get(peer.id, 0) + 1
+        return requests
+
+
+class RandomFirst(RarestFirst):
+    """
+    Ask for pieces in random order until the agent has `first` complete
+    pieces, so it quickly has something to trade; rarest first after that.
+    """
+    def __init__(self, first=1, rng=random):
+        RarestFirst.__init__(self, rng)
+        self.first = first
+
+    def order(self, agent, holders):
+        complete = len(agent.pieces) - len(self.queue)
+        if complete >= self.first:
+            return RarestFirst.order(self, agent, holders)
+        pieces = sorted(holders)
+        self.rng.shuffle(pieces)
+        return pieces
+
+
+class Endgame(RarestFirst):
+    """
+    Rarest first, until only `threshold` pieces are left.  Then ask every
+    peer that has them for all of them, so a slow peer can't hold up the
+    last piece.
+    """
+    def __init__(self, threshold=2, rng=random):
+        RarestFirst.__init__(self, rng)
+        self.threshold = threshold
+
+    def limit(self, agent, needed):
+        if len(needed) <= self.threshold:
+            return len(needed)
+        return RarestFirst.limit(self, agent, needed)
+
+
+class StrictPriority(RarestFirst):
+    """
+    Finish the pieces that have been started before starting new ones;
+    rarest first within each group.
+    """
+    def order(self, agent, holders):
+        pieces = RarestFirst.order(self, agent, holders)
+        started = [i for i in pieces if agent.pieces[i] > 0]
+        fresh = [i for i in pieces if agent.pieces[i] == 0]
+        return started + fresh
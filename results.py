@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# Results sinks: write each iteration's stats to a file as soon as the
+# iteration is done, so other tools can follow the file while the sim
+# runs.  Picked with sim.py --results FILE --results-format FORMAT.
+
+import csv
+import json
+
+from util import whole_to_int
+
+
+class JsonLinesSink:
+    """
+    One JSON object per iteration:
+    {"iteration": 0, "seed": 17, "all_done_round": 12,
+     "uploaded_blocks": {peer_id: blocks}, "completion_rounds": {peer_id: round}}
+    Peers that didn't finish have a completion round of null.
+    """
+    def __init__(self, path, peer_ids, class_names):
+        self.f = open(path, "w")
+
+    def write(self, iteration, seed, uploaded, completion, all_done):
+        record = {"iteration": iteration,
+                  "seed": seed,
+                  "all_done_round": all_done,
+                  "uploaded_blocks": dict((peer_id, whole_to_int(blocks))
+                                          for (peer_id, blocks)
+                                          in uploaded.iteritems()),
+                  "completion_rounds": completion}
+        self.f.write(json.dumps(record, sort_keys=True) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CsvSink:
+    """
+    One row per peer per iteration, with columns
+    iteration, seed, peer_id, agent_class, uploaded_blocks,
+    completion_round, all_done_round.
+    Rounds that never happened (the peer didn't finish) are left empty.
+    """
+    columns = ["iteration", "seed", "peer_id", "agent_class",
+               "uploaded_blocks", "completion_round", "all_done_round"]
+
+    def __init__(self, path, peer_ids, class_names):
+        self.f = open(path, "w")
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.columns)
+        self.peers = zip(peer_ids, class_names)
+
+    def write(self, iteration, seed, uploaded, completion, all_done):
+        blank = lambda x: "" if x is None else x
+        for (peer_id, class_name) in self.peers:
+            self.writer.writerow([iteration, seed, peer_id, class_name,
+                                  whole_to_int(uploaded[peer_id]),
+                                  blank(completion[peer_id]),
+                                  blank(all_done)])
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+SINKS = {"jsonl": JsonLinesSink, "csv": CsvSink}
@@ -12,20 +12,175 @@ import re
 import random
 import sys
 import logging
-import copy
 import itertools
+import functools
 import pprint
+import multiprocessing
+import threading
+import time
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, Download, PeerInfo, PeerView, RarityView
 from util import *
 from stats import Stats
 from history import History
+from agenthost import AgentHosts
+from results import SINKS
+from tracefile import TraceWriter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ListPieces:
+    """
+    Block counts for every peer, kept as a dict of Python lists:
+    peer_id -> [blocks of each piece]
+
+    Also counts, for each peer, the pieces it hasn't finished yet, so
+    done checks don't need to look at the pieces.
+    unfinished is the number of peers that aren't done.
+    """
+    def __init__(self, conf, peer_ids, peer_pieces):
+        self.conf = conf
+        self.rows = peer_pieces
+        bpp = conf.blocks_per_piece
+        self.remaining = dict(
+            (pid, len([b for b in peer_pieces[pid] if b < bpp]))
+            for pid in peer_ids)
+        self.unfinished = len([pid for pid in peer_ids
+                               if self.remaining[pid] > 0])
+
+    def pieces(self, peer_id):
+        """A copy of the block counts for peer_id, safe to give away"""
+        return self.rows[peer_id][:]
+
+    def blocks(self, peer_id, piece_id):
+        return self.rows[peer_id][piece_id]
+
+    def available_pieces(self, peer_id):
+        """
+        Return a list of piece ids that this peer has available.
+        """
+        return filter(lambda i: self.rows[peer_id][i] == self.conf.blocks_per_piece,
+                      range(self.conf.num_pieces))
+
+    def peer_done(self, peer_id):
+        return self.remaining[peer_id] == 0
+
+    def add_blocks(self, received):
+        """
+        received: [(peer_id, piece_id, blocks)], at most one entry for each
+        (peer_id, piece_id).
+
+        Add the blocks to the counts.  Returns a pair:
+        ([(peer_id, piece_id)] whose piece just got completed, in the order
+         they were received,
+         [peer_id] of the peers that just got done)
+        """
+        bpp = self.conf.blocks_per_piece
+        completed = []
+        done = []
+        for (peer_id, piece_id, blocks) in received:
+            row = self.rows[peer_id]
+            old = row[piece_id]
+            row[piece_id] += blocks
+            if row[piece_id] == bpp:
+                completed.append((peer_id, piece_id))
+            if old < bpp <= row[piece_id]:
+                self.remaining[peer_id] -= 1
+                if self.remaining[peer_id] == 0:
+                    done.append(peer_id)
+                    self.unfinished -= 1
+        return (completed, done)
+
+
+class NumpyPieces:
+    """
+    Same interface as ListPieces, but the block counts live in a
+    peers x pieces array and the completed pieces in a boolean bitmap of
+    the same shape, so updates and done checks are array operations.
+    Needs numpy.
+
+    The counts are stored as floats, because agents may upload fractional
+    bandwidths; whole counts are handed back out as ints.
+    """
+    def __init__(self, conf, peer_ids, peer_pieces):
+        self.conf = conf
+        self.peer_ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.counts = numpy.array([peer_pieces[pid] for pid in peer_ids],
+                                  dtype=float).reshape(len(peer_ids),
+                                                     conf.num_pieces)
+        self.complete = self.counts == conf.blocks_per_piece
+        self.remaining = (self.counts < conf.blocks_per_piece).sum(axis=1)
+        self.unfinished = int((self.remaining > 0).sum())
+
+    def pieces(self, peer_id):
+        return map(whole_to_int, self.counts[self.index[peer_id]].tolist())
+
+    def blocks(self, peer_id, piece_id):
+        return whole_to_int(float(self.counts[self.index[peer_id], piece_id]))
+
+    def available_pieces(self, peer_id):
+        return numpy.flatnonzero(self.complete[self.index[peer_id]]).tolist()
+
+    def peer_done(self, peer_id):
+        return self.remaining[self.index[peer_id]] == 0
+
+    def add_blocks(self, received):
+        if len(received) == 0:
+            return ([], [])
+        bpp = self.conf.blocks_per_piece
+        peer_ids, piece_ids, blocks = zip(*received)
+        rows = numpy.array([self.index[pid] for pid in peer_ids])
+        cols = numpy.array(piece_ids)
+        old = self.counts[rows, cols]
+        numpy.add.at(self.counts, (rows, cols), blocks)
+        new = self.counts[rows, cols]
+        hit = new == bpp
+        self.complete[rows[hit], cols[hit]] = True
+        finished = rows[(old < bpp) & (new >= bpp)]
+        numpy.subtract.at(self.remaining, finished, 1)
+        done_rows = [i for i in numpy.unique(finished)
+                     if self.remaining[i] == 0]
+        self.unfinished -= len(done_rows)
+        return ([(peer_ids[k], piece_ids[k]) for k in numpy.flatnonzero(hit)],
+                [self.peer_ids[i] for i in done_rows])
+
+
+# --engine name -> piece state class
+ENGINES = {"list": ListPieces, "numpy": NumpyPieces}
+
+
+class DecisionThread(threading.Thread):
+    """
+    Runs one agent's requests() or uploads() call.  The result, or the
+    exception it raised, is kept for the sim to pick up.  Daemon, so an
+    agent that never returns doesn't keep the sim from exiting.
+    """
+    def __init__(self, call):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.call = call
+        self.result = None
+        self.error = None  # sys.exc_info() if call raised
+
+    def run(self):
+        try:
+            self.result = self.call()
+        except:
+            self.error = sys.exc_info()
+
 
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        # For the peers' bandwidths, which every iteration shares
+        self.rng = random.Random(config.seed)
 
     
     def up_bw(self, peer_id):
@@ -34,16 +189,50 @@ class Sim:
         s = self.up_bws_state
         
         """Sets the upload bandwidth of seeds to max, other agents at random"""
+        if peer_id in s:
+            # Don't use up random numbers once it's picked: whether and how
+            # often this is called mustn't change the rest of the sim.
+            return s[peer_id]
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
-        else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
+        else: the_up_bw = self.rng.randint(c.min_up_bw, c.max_up_bw)
         
         return s.setdefault(peer_id, the_up_bw)
 
-    def run_sim_once(self):
-        """Return a history"""
+    def make_peer_ids(self):
+        """Return the peer ids for the configured agents, in order:
+        each class name followed by its index among agents of that class."""
+        counts = dict()
+        def index(name):
+            if name in counts:
+                a = counts[name]
+                counts[name] += 1
+            else:
+                a = 0
+                counts[name] = 1
+            return a
+
+        return map(lambda n: "%s%d" % (n,index(n)),
+                   self.config.agent_class_names)
+
+    def run_sim_once(self, seed=None):
+        """Return a history.  If seed is given, each agent gets its own
+        random stream made from it, so the same seed always gives the same
+        history.  The random module is seeded with it too, for agents
+        that still use it."""
         conf = self.config
+        if seed is not None:
+            random.seed(seed)
+        # Seeds for the agents' random streams, one per peer in order
+        agent_seeds = random.Random(seed)
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
+        # The (request check, upload check) for this round.  Depends on
+        # the --validate policy, see pick_checks.
+        checks = None
+        # Decides which rounds get checked under the "sampled" policy.
+        # Separate from the random module so that sampling doesn't change
+        # what happens in the sim.
+        sample_rng = random.Random(seed)
 
         def check_pred(pred, msg, Exc, lst):
             """Check if any element of lst matches the predicate.  If it does,
@@ -99,62 +288,115 @@ class Sim:
             bad_start_block = lambda r: (
                 r.start < 0 or
                 r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
+                r.start > peer_pieces.blocks(peer.id, r.piece_id))
             # Must request the _next_ necessary block
             check(bad_start_block, "Request has bad start block!")
 
             def piece_peer_does_not_have(r):
                 other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
+                return r.piece_id not in available[other_peer.id].available_pieces
             check(piece_peer_does_not_have, "Asking for piece peer does not have!")
             
             # If we got here, looks ok
 
-        def available_pieces(peer_id, peer_pieces):
+        def fused_check_uploads(peer, uploads):
+            """The same checks as check_uploads, in one pass over the
+            uploads.  Reports the first upload that fails any of them."""
+            total = 0
+            for u in uploads:
+                if not isinstance(u, Upload):
+                    msg = "List of Uploads contains non-Upload object."
+                elif u.to_id == peer.id:
+                    msg = "Can't upload to yourself."
+                elif u.from_id != peer.id:
+                    msg = "Upload.from != peer id."
+                elif u.bw < 0:
+                    msg = "Upload bandwidth must be non-negative!"
+                else:
+                    total += u.bw
+                    continue
+                raise IllegalUpload(msg + " Bad element: %s" % u)
+
+            limit = self.up_bw(peer.id)
+            if total > limit:
+                raise IllegalUpload("Can't upload more than limit of %d. %s" % (
+                    limit, uploads))
+
+        def fused_check_requests(peer, requests, peer_pieces, available):
+            """The same checks as check_requests, in one pass over the
+            requests.  Reports the first request that fails any of them."""
+            for r in requests:
+                if not isinstance(r, Request):
+                    msg = "List of Requests contains non-Request object."
+                elif r.piece_id < 0 or r.piece_id >= conf.num_pieces:
+                    msg = "Request asks for non-existent piece!"
+                elif r.peer_id not in self.peers_by_id:
+                    msg = "Request mentions non-existent peer!"
+                elif r.requester_id != peer.id:
+                    msg = "Request has wrong peer id!"
+                elif (r.start < 0 or
+                      r.start >= conf.blocks_per_piece or
+                      r.start > peer_pieces.blocks(peer.id, r.piece_id)):
+                    msg = "Request has bad start block!"
+                elif r.piece_id not in available[r.peer_id].available_pieces:
+                    msg = "Asking for piece peer does not have!"
+                else:
+                    continue
+                raise IllegalRequest(msg + " Bad element: %s" % r)
+
+        def no_check(*args):
+            pass
+
+        def pick_checks():
             """
-            Return a list of piece ids that this peer has available.
+            Return the (request check, upload check) to use this round:
+            full: the separate checks for each problem, every round
+            fused: the one-pass checks, every round
+            sampled: the one-pass checks, in a random validate_fraction
+                of the rounds
+            off: no checks.  Only for agents known to behave.
             """
-            return filter(lambda i: peer_pieces[peer_id][i] == conf.blocks_per_piece,
-                          range(conf.num_pieces))
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-            
+            full = (check_requests, check_uploads)
+            fused = (fused_check_requests, fused_check_uploads)
+            off = (no_check, no_check)
+            if conf.validate == "full":
+                return full
+            if conf.validate == "fused":
+                return fused
+            if conf.validate == "sampled":
+                if sample_rng.random() < conf.validate_fraction:
+                    return fused
+                return off
+            if conf.validate == "off":
+                return off
+            raise ValueError("Unknown validation policy: %s" % conf.validate)
+
+        def skip_requests(p):
+            """With the active scheduler, peers that are done don't get
+            asked for requests (unless they need every round)."""
+            return (active_only and not p.needs_every_round and
+                    peer_pieces.peer_done(p.id))
+
+        def skip_uploads(p, requests):
+            """With the active scheduler, peers that nobody asked for
+            anything don't get asked for uploads (unless they need every
+            round)."""
+            return (active_only and not p.needs_every_round and
+                    len(requests) == 0)
+
         def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+            return peer_pieces.unfinished == 0
 
         def create_peers():
             """Each agent class must be already loaded, and have a
-            constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            constructor that takes the config, id,  pieces, up
+            bandwidth and random stream, in that order."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
                 return agent_class(*params)
 
-            counts = dict()
-            def index(name):
-                if name in counts:
-                    a = counts[name]
-                    counts[name] += 1
-                else:
-                    a = 0
-                    counts[name] = 1
-                return a
-
-            n = len(conf.agent_class_names)
-            ids = map(lambda n: "%s%d" % (n,index(n)), conf.agent_class_names)
+            ids = self.make_peer_ids()
 
             is_seed = lambda id: id.startswith("Seed")
 
@@ -166,46 +408,156 @@ class Sim:
                 
             peer_pieces = dict()  # id -> list (blocks / piece)
             peer_pieces = dict((id, get_pieces(id)) for id in ids)
+            peer_pieces = ENGINES[conf.engine](conf, ids, peer_pieces)
             pieces = [get_pieces(id) for id in ids]
             r = itertools.repeat
             up_bws = [self.up_bw(id) for id in ids]
-            params = zip(r(conf), ids, pieces, up_bws)
-
-            peers = map(load, conf.agent_class_names, params)
+            rng_seeds = [agent_seeds.getrandbits(64) for id in ids]
+            rngs = [random.Random(s) for s in rng_seeds]
+            params = zip(r(conf), ids, pieces, up_bws, rngs)
+
+            if conf.agent_hosts:
+                hosts = AgentHosts(conf, conf.agent_class_names, ids, pieces,
+                                   up_bws, rng_seeds, conf.agent_hosts, seed)
+                peers = hosts.peers
+            else:
+                hosts = None
+                peers = map(load, conf.agent_class_names, params)
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
-            return peers, peer_pieces
+            return peers, peer_pieces, hosts
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
+        def update_peer(p, peer_pieces):
+            pieces = peer_pieces.pieces(p.id)
+            # Made copy of pieces this peer needs to make it's decision, and
+            # it only gets a view of the peer info, so that it can't change
+            # the simulation's copies.
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
-            return rs
+            p.update_rarity(rarity)
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return filter(lambda peer: peer.id != p.id, peer_info)
+        def still_busy(p):
+            """
+            True if a call to p timed out in an earlier phase and is still
+            running.  p isn't asked again (and gets nothing new: no pieces,
+            no history) until that call returns, so two threads never use
+            the same agent at once.  It makes no requests or uploads
+            meanwhile.
+            """
+            t = busy.get(p.id)
+            if t is None:
+                return False
+            if t.isAlive():
+                logging.warning("%s is still deciding, using []", p.id)
+                return True
+            del busy[p.id]
+            return False
+
+        def agent_history(p):
+            """The history to give p this round: all of it, or an
+            AgentDelta of the rounds since p last got one"""
+            if hosts is not None:
+                # The hosts keep their agents' histories
+                return None
+            if not p.history_deltas:
+                return history.peer_history(p.id)
+            since = told.get(p.id, 0)
+            told[p.id] = history.num_rounds()
+            return history.delta(p.id, since)
+
+        def decide(calls):
+            """
+            calls: [(p, call)], in peer order, where call() returns p's
+            requests or uploads for this phase.
+            Returns dict : peer_id -> what call() returned.
+
+            With --decisions threads, the calls of agents that set
+            concurrent run at the same time, each on its own thread, and
+            any that take longer than --decision-timeout seconds get []
+            (the late call keeps running, and its result is thrown away;
+            see still_busy for what happens to the agent until it returns).
+            The rest are called one at a time, in order, as usual, and
+            the timeout starts once they're done.
+            Results are collected by peer id, and exceptions re-raised in
+            peer order, so it doesn't matter which thread finishes first.
+            """
+            results = dict()
+            threads = []
+            for (p, call) in calls:
+                if conf.decisions == "threads" and p.concurrent:
+                    t = DecisionThread(call)
+                    t.start()
+                    threads.append((p, t))
+                else:
+                    results[p.id] = call()
 
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in all_requests.values():
-                    ans.extend(filter(f, rs))
-                return ans
+            # The serial calls' time doesn't count against the threads
+            start = time.time()
+            for (p, t) in threads:
+                if conf.decision_timeout > 0:
+                    t.join(max(0, start + conf.decision_timeout - time.time()))
+                else:
+                    t.join()
+                if t.isAlive():
+                    logging.warning("%s took more than %s seconds to decide, "
+                                    "using []", p.id, conf.decision_timeout)
+                    results[p.id] = []
+                    busy[p.id] = t
+                elif t.error is not None:
+                    raise t.error[0], t.error[1], t.error[2]
+                else:
+                    results[p.id] = t.result
+            return results
 
-            requests = requests_to(p.id)
+        def get_peer_requests(ps, peer_info, h, peer_pieces, available):
+            """
+            ps: the peers to ask this round
+            h: dict : peer_id -> AgentHistory, for each peer in ps
+            Returns dict : peer_id -> list of Requests
+            """
+            for p in ps:
+                update_peer(p, peer_pieces)
+            if hosts is not None:
+                rs = hosts.decide(round, "requests",
+                                  dict((p.id, None) for p in ps), history,
+                                  available, piece_completions, host_timeout)
+            else:
+                rs = decide([(p, functools.partial(
+                    p.requests, PeerView(peer_info, info_index, p.id), h[p.id]))
+                             for p in ps])
+            for p in ps:
+                checks[0](p, rs[p.id], peer_pieces, available)
+            return rs
 
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
+        def get_peer_uploads(inbox, ps, peer_info, h):
+            """
+            inbox: dict : peer_id -> the requests made to that peer this round
+            Returns dict : peer_id -> list of Uploads, for each peer in ps
+            """
+            if hosts is not None:
+                us = hosts.decide(round, "uploads",
+                                  dict((p.id, inbox[p.id]) for p in ps),
+                                  history, available, piece_completions,
+                                  host_timeout)
+            else:
+                us = decide([(p, functools.partial(
+                    p.uploads, inbox[p.id],
+                    PeerView(peer_info, info_index, p.id), h[p.id]))
+                             for p in ps])
+            for p in ps:
+                checks[1](p, us[p.id])
             return us
 
+        def route_requests(requests):
+            """
+            Build each peer's inbox for this round.
+            requests: dict : requester_id -> [Requests]
+            Returns dict : peer_id -> [Requests made to that peer]
+            """
+            inbox = dict((pid, []) for pid in self.peer_ids)
+            for rs in requests.values():
+                for r in rs:
+                    inbox[r.peer_id].append(r)
+            return inbox
+
         def upload_rate(uploads, uploader_id, requester_id):
             """
             return the uploading rate from uploader to requester
@@ -222,10 +574,15 @@ class Sim:
             pieces the requesters ended up with.
             Make sure requesting the same thing from lots of peers doesn't
             stack.
-            update the sets of available pieces as needed.
+            Make new PeerInfo (with a new frozenset of available pieces)
+            for the peers that completed pieces, and count them in the
+            rarity index.
+            Tell the history about peers that just got done.
+
+            peer_pieces is updated in place.
             """
             downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
+            received = []  # (requester_id, piece_id, blocks)
             for requester_id in requests:
                 downloads[requester_id] = list()
             for requester_id in requests:
@@ -257,135 +614,302 @@ class Sim:
                             break
                 for piece_id in new_blocks_per_piece:
                     (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
+                    received.append((requester_id, piece_id, blocks))
                     d = Download(peer_id, requester_id, piece_id, blocks)
                     downloads[requester_id].append(d)
+
+            (completed, done) = peer_pieces.add_blocks(received)
+            new_pieces = dict()  # peer_id -> [newly completed piece ids]
+            for (requester_id, piece_id) in completed:
+                new_pieces.setdefault(requester_id, []).append(piece_id)
+                piece_counts[piece_id] += 1
+                piece_completions.append((requester_id, piece_id))
+            for (requester_id, piece_ids) in new_pieces.iteritems():
+                old = available[requester_id]
+                available[requester_id] = PeerInfo(
+                    requester_id, old.available_pieces.union(piece_ids),
+                    old.version + 1)
+            for peer_id in done:
+                history.peer_is_done(round, peer_id)
                 
-            return (new_pp, downloads)
+            return downloads
 
         def completed_pieces(peer_id, available):
-            return len(available[peer_id])
+            return len(available[peer_id].available_pieces)
         
         def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
-
-        peers, peer_pieces = create_peers()
+            if logging.root.isEnabledFor(logging.DEBUG):
+                for p_id in self.peer_ids:
+                    pieces = peer_pieces.pieces(p_id)
+                    logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
+            if logging.root.isEnabledFor(logging.INFO):
+                log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: " + log)
+
+        # Quiet mode skips the per-round and end of game logging altogether.
+        verbose = not conf.quiet
+        # Only call the agents that have something to do, see skip_requests
+        # and skip_uploads.
+        active_only = conf.scheduler == "active"
+        # Peers whose final pieces have been passed on after they got done
+        finished = set()
+
+        logging.debug("Starting simulation with config: %s", conf)
+
+        peers, peer_pieces, hosts = create_peers()
         self.peer_ids = [p.id for p in peers]
         self.peers_by_id = dict((p.id, p) for p in peers)
         
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
+        history = History(self.peer_ids, upload_rates, conf.history_window,
+                          conf.recent_rounds)
 
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        if conf.trace:
+            path = conf.trace.replace("{seed}", str(seed))
+            tracer = TraceWriter(path, history, conf)
+        else:
+            tracer = None
 
-        # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-                
+        # peer_id -> the number of rounds of history it has been given,
+        # for agents that get AgentDeltas
+        told = dict()
 
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
+        # peer_id -> the DecisionThread of a call to it that timed out and
+        # may still be running
+        busy = dict()
 
-            logging.debug(history.pretty_for_round(round))
+        # Where each peer's PeerInfo is in the round's peer_info list
+        info_index = dict((p.id, i) for (i, p) in enumerate(peers))
+
+        # Peers that start out done (the seeds) count as done in round 0
+        for pid in self.peer_ids:
+            if peer_pieces.peer_done(pid):
+                history.peer_is_done(round, pid)
+
+        # dict : pid -> PeerInfo with its finished / available pieces.  A new
+        # PeerInfo replaces the old one when the peer completes pieces.
+        available = dict((pid, PeerInfo(pid, peer_pieces.available_pieces(pid)))
+                         for pid in self.peer_ids)
 
-            log_peer_info(peer_pieces, available)
+        # How many peers have each piece available.  Agents get a read-only
+        # view of it.
+        piece_counts = [0] * conf.num_pieces
+        for pid in self.peer_ids:
+            for piece_id in available[pid].available_pieces:
+                piece_counts[piece_id] += 1
+        piece_completions = []
+        rarity = RarityView(piece_counts, piece_completions)
+
+        # With --agent-hosts, how long to wait for the hosts each phase
+        host_timeout = conf.decision_timeout or None
+
+        # Begin the event loop
+        try:
+            while True:
+                if verbose:
+                    logging.info("======= Round %d ========", round)
+                checks = pick_checks()
+
+                peer_info = [available[p.id] for p in peers]
+                h = dict()
+                asked = []
+                for p in peers:
+                    if skip_requests(p):
+                        if p.id not in finished and not still_busy(p):
+                            # Still tell it about its last pieces
+                            update_peer(p, peer_pieces)
+                            finished.add(p.id)
+                        continue
+                    if still_busy(p):
+                        continue
+                    h[p.id] = agent_history(p)
+                    asked.append(p)
+                made = get_peer_requests(asked, peer_info, h, peer_pieces,
+                                         available)
+                requests = dict()  # peer_id -> list of Requests
+                for p in peers:
+                    requests[p.id] = made.get(p.id, [])
+
+                inbox = route_requests(requests)
+                asked = []
+                for p in peers:
+                    if skip_uploads(p, inbox[p.id]) or still_busy(p):
+                        continue
+                    if p.id not in h:
+                        h[p.id] = agent_history(p)
+                    asked.append(p)
+                made = get_peer_uploads(inbox, asked, peer_info, h)
+                uploads = dict()   # peer_id -> list of Uploads
+                for p in peers:
+                    uploads[p.id] = made.get(p.id, [])
+
+                downloads = update_peer_pieces(
+                    peer_pieces, requests, uploads, available)
+                history.update(downloads, uploads)
+                if tracer is not None:
+                    tracer.write_round(round)
+
+                if verbose:
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        logging.debug(history.pretty_for_round(round))
+                    log_peer_info(peer_pieces, available)
            
-            if all_done(peer_pieces):
-                logging.info("All done!")                    
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
-                break
-
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+                if all_done(peer_pieces):
+                    if verbose:
+                        logging.info("All done!")
+                    break
+                round += 1
+                if round > conf.max_round:
+                    if verbose:
+                        logging.info("Out of time.  Stopping.")
+                    break
+        finally:
+            if hosts is not None:
+                hosts.stop()
+            if tracer is not None:
+                tracer.close()
+
+        if verbose and logging.root.isEnabledFor(logging.INFO):
+            logging.info("Game history:\n%s" % history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s" %
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s" %
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s" %
+                         Stats.all_done_round(self.peer_ids, history))
 
         return history
 
+    def iteration_numbers(self):
+        """The iterations to run: all of them, or just --replay-iter"""
+        if self.config.replay_iter is not None:
+            return [self.config.replay_iter]
+        return xrange(self.config.iters)
+
+    def iteration_seeds(self):
+        """Generator of one seed per iteration, derived from the base seed."""
+        return (self.config.seed + i for i in self.iteration_numbers())
+
+    def run_iteration(self, i, seed):
+        """Run iteration i with the given seed.  Returns
+        (uploaded blocks, completion rounds, all done round), the first two
+        dicts keyed by peer id."""
+        logging.info("Iteration %d seed: %d (replay with --seed %d "
+                     "--replay-iter %d)", i, seed, self.config.seed, i)
+        history = self.run_sim_once(seed)
+        return (Stats.uploaded_blocks(self.peer_ids, history),
+                Stats.completion_rounds(self.peer_ids, history),
+                Stats.all_done_round(self.peer_ids, history))
+
     def run_sim(self):
-        histories = map(lambda i: self.run_sim_once(), 
-                        range(self.config.iters))
-        logging.warning("======== SUMMARY STATS ========")
-        
-        uploaded_blocks = map(
-            lambda h: Stats.uploaded_blocks(self.peer_ids, h),
-            histories)
-        completion_rounds = map(
-            lambda h: Stats.completion_rounds(self.peer_ids, h),
-            histories)
-
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return map(lambda d: d[peer_id], lst)
-
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
+        conf = self.config
+        self.peer_ids = self.make_peer_ids()
 
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
+        # Pick every peer's bandwidth up front, so all the iterations see the
+        # same ones whether they run here or in a worker process.
+        for p_id in self.peer_ids:
+            self.up_bw(p_id)
+
+        if conf.results:
+            sink = SINKS[conf.results_format](
+                conf.results, self.peer_ids, conf.agent_class_names)
+        else:
+            sink = None
+        # Seeds are made as the iterations are handed out, not up front
+        iterations = itertools.izip(self.iteration_numbers(),
+                                    self.iteration_seeds())
+        pool = None
+        if conf.workers > 1:
+            pool = multiprocessing.Pool(conf.workers)
+            # In order, as each one is done
+            done = pool.imap(run_iteration,
+                             ((self, i, s) for (i, s) in iterations))
+        else:
+            done = itertools.starmap(self.run_iteration, iterations)
+
+        # Summaries of each peer's results, updated as the iterations
+        # finish, so memory doesn't grow with --iters.
+        uploaded_by_id = dict((p_id, RunningStats())
+                              for p_id in self.peer_ids)
+        completion_by_id = dict((p_id, RunningStats())
+                                for p_id in self.peer_ids)
+        quantiles = (0.5, 0.95, 0.99)
+        completion_quantiles = dict(
+            (p_id, [P2Quantile(q) for q in quantiles])
             for p_id in self.peer_ids)
+        # p_id -> number of iterations the peer didn't finish
+        unfinished = dict((p_id, 0) for p_id in self.peer_ids)
+
+        def add_iteration(uploaded, completion):
+            for p_id in self.peer_ids:
+                uploaded_by_id[p_id].add(uploaded[p_id])
+                c = completion[p_id]
+                if c is None:
+                    unfinished[p_id] += 1
+                    continue
+                completion_by_id[p_id].add(c)
+                for q in completion_quantiles[p_id]:
+                    q.add(c)
+
+        try:
+            for (i, s, (uploaded, completion, all_done)) in itertools.izip(
+                    self.iteration_numbers(), self.iteration_seeds(), done):
+                if sink is not None:
+                    sink.write(i, s, uploaded, completion, all_done)
+                add_iteration(uploaded, completion)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if sink is not None:
+                sink.close()
+
+        logging.warning("======== SUMMARY STATS ========")
 
         logging.warning("Upload bandwidth: avg (stddev)")
         for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
+                           key=lambda id: uploaded_by_id[id].mean()):
             us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+            logging.warning("%s: %.1f  (%.1f)" % (p_id, us.mean(), us.stddev()))
 
         logging.warning("Completion rounds: avg (stddev)")
 
+        # None for peers that didn't finish every iteration
         def optionize(f):
-            def g(lst):
-                if None in lst:
+            def g(p_id):
+                if unfinished[p_id]:
                     return None
                 else:
-                    return f(lst)
+                    return f(p_id)
             return g
 
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
-        
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
-            cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+        opt_mean = optionize(lambda id: completion_by_id[id].mean())
+        opt_stddev = optionize(lambda id: completion_by_id[id].stddev())
+        opt_quantiles = optionize(
+            lambda id: [q.value() for q in completion_quantiles[id]])
+
+        for p_id in sorted(self.peer_ids, key=opt_mean):
+            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(p_id),
+                                              opt_stddev(p_id)))
+
+        logging.warning("Completion rounds: median, p95, p99")
+        for p_id in sorted(self.peer_ids, key=opt_mean):
+            qs = opt_quantiles(p_id)
+            if qs is None:
+                logging.warning("%s: None" % p_id)
+            else:
+                logging.warning("%s: %s, %s, %s" % ((p_id,) + tuple(qs)))
 
 
+def run_iteration(args):
+    """Worker entry point for Sim.run_sim.  args is a (sim, iteration,
+    seed) tuple.  Lives at module level so multiprocessing can pickle it."""
+    sim, i, seed = args
+    return sim.run_iteration(i, seed)
+
 
 def configure_logging(loglevel):
     numeric_level = getattr(logging, loglevel.upper(), None)
@@ -421,7 +945,49 @@ def parse_agents(args):
             
         
 
-def main(args):
+def check_options(options):
+    """
+    Raise ValueError if options (as made by parse_args, or by sweep.py
+    for its cells) don't make sense.
+    """
+    if options.history_window < 0:
+        raise ValueError("--history-window can't be negative")
+    if options.recent_rounds < 1:
+        raise ValueError("--recent-rounds must be at least 1")
+    if options.validate not in ("full", "fused", "sampled", "off"):
+        raise ValueError("Unknown validation policy: %s" % options.validate)
+    if not 0 <= options.validate_fraction <= 1:
+        raise ValueError("--validate-fraction must be between 0 and 1")
+    if options.scheduler not in ("full", "active"):
+        raise ValueError("Unknown scheduler: %s" % options.scheduler)
+    if options.decisions not in ("serial", "threads"):
+        raise ValueError("Unknown decisions mode: %s" % options.decisions)
+    if options.decision_timeout < 0:
+        raise ValueError("--decision-timeout can't be negative")
+    if options.replay_iter is not None and options.replay_iter < 0:
+        raise ValueError("--replay-iter can't be negative")
+    if options.results_format not in SINKS:
+        raise ValueError("Unknown results format: %s" %
+                         options.results_format)
+    if (options.trace and "{seed}" not in options.trace and
+        options.iters > 1 and options.replay_iter is None):
+        raise ValueError("--trace needs {seed} in the file name with --iters")
+    if options.agent_hosts < 0:
+        raise ValueError("--agent-hosts can't be negative")
+    if options.agent_hosts and options.workers > 1:
+        raise ValueError("--agent-hosts can't be used with --workers")
+    if options.engine not in ENGINES:
+        raise ValueError("Unknown engine: %s" % options.engine)
+    if options.engine == "numpy" and numpy is None:
+        raise ValueError("--engine numpy needs numpy installed")
+
+
+def parse_args(args):
+    """
+    args: the command line, program name first.
+    Returns (options, agents_to_run).  Exits with a usage message if
+    the arguments are bad.
+    """
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
     parser = OptionParser(usage=usage_msg)
 
@@ -458,8 +1024,84 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
-
-    (options, args) = parser.parse_args()
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Base random seed.  Picked at random if not given")
+
+    parser.add_option("--replay-iter",
+                      dest="replay_iter", default=None, type="int",
+                      help="Only run this iteration (counting from 0) of a "
+                      "run with the same --seed, e.g. to profile it")
+
+    parser.add_option("--results",
+                      dest="results", default=None,
+                      help="Write each iteration's stats to this file as "
+                      "it finishes")
+
+    parser.add_option("--results-format",
+                      dest="results_format", default="jsonl",
+                      help="Format for --results: 'jsonl' or 'csv'")
+
+    parser.add_option("--trace",
+                      dest="trace", default=None,
+                      help="Write each iteration's history to this binary "
+                      "trace file, with {seed} replaced by its seed")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to run iterations in")
+
+    parser.add_option("--engine",
+                      dest="engine", default="list",
+                      help="Piece state engine: 'list' or 'numpy'")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=0, type="int",
+                      help="Only keep this many recent rounds of history "
+                      "(0 keeps them all)")
+
+    parser.add_option("--recent-rounds",
+                      dest="recent_rounds", default=3, type="int",
+                      help="Number of rounds that AgentHistory.received_recent "
+                      "covers")
+
+    parser.add_option("--quiet",
+                      dest="quiet", default=False, action="store_true",
+                      help="Skip the per-round and end of game logging")
+
+    parser.add_option("--validate",
+                      dest="validate", default="full",
+                      help="How to check agents' requests and uploads: "
+                      "'full', 'fused' (one pass), 'sampled' or 'off'")
+
+    parser.add_option("--validate-fraction",
+                      dest="validate_fraction", default=0.1, type="float",
+                      help="Fraction of rounds to check with --validate sampled")
+
+    parser.add_option("--scheduler",
+                      dest="scheduler", default="full",
+                      help="'full' calls every agent every round, 'active' "
+                      "only the ones with something to do")
+
+    parser.add_option("--decisions",
+                      dest="decisions", default="serial",
+                      help="'serial' calls agents one at a time, 'threads' "
+                      "runs the agents that set concurrent at the same time")
+
+    parser.add_option("--decision-timeout",
+                      dest="decision_timeout", default=0, type="float",
+                      help="Seconds to wait for decisions before using [] "
+                      "(0 waits forever): for each concurrent agent with "
+                      "--decisions threads, and for the hosts' answers "
+                      "each phase with --agent-hosts")
+
+    parser.add_option("--agent-hosts",
+                      dest="agent_hosts", default=0, type="int",
+                      help="Run the agents in this many separate processes "
+                      "(0 runs them in the sim's process)")
+
+
+    (options, args) = parser.parse_args(args[1:])
 
     # leftover args are class names, with optional counts:
     # "Peer Seed[,4]"
@@ -473,7 +1115,16 @@ def main(args):
         except ValueError, e:
             usage(e)
     
-    configure_logging(options.loglevel)
+    try:
+        check_options(options)
+    except ValueError, e:
+        usage(e)
+
+    return (options, agents_to_run)
+
+
+def make_config(options, agents_to_run):
+    """Build the Params for a Sim from parsed options"""
     config = Params()
 
     config.add("agent_class_names", agents_to_run)
@@ -486,7 +1137,34 @@ def main(args):
     config.add("min_up_bw", options.min_up_bw)
     config.add("max_up_bw", options.max_up_bw)
     config.add("iters", options.iters)
-    
+    config.add("seed", options.seed)
+    config.add("replay_iter", options.replay_iter)
+    config.add("results", options.results)
+    config.add("results_format", options.results_format)
+    config.add("trace", options.trace)
+    config.add("workers", options.workers)
+    config.add("engine", options.engine)
+    config.add("history_window", options.history_window)
+    config.add("recent_rounds", options.recent_rounds)
+    config.add("quiet", options.quiet)
+    config.add("validate", options.validate)
+    config.add("validate_fraction", options.validate_fraction)
+    config.add("scheduler", options.scheduler)
+    config.add("decisions", options.decisions)
+    config.add("decision_timeout", options.decision_timeout)
+    config.add("agent_hosts", options.agent_hosts)
+    return config
+
+
+def main(args):
+    (options, agents_to_run) = parse_args(args)
+
+    configure_logging(options.loglevel)
+    if options.seed is None:
+        options.seed = random.randint(0, sys.maxint)
+    logging.info("Base seed: %d" % options.seed)
+
+    config = make_config(options, agents_to_run)
     sim = Sim(config)
     sim.run_sim()
 
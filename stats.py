@@ -1,5 +1,11 @@
 #!/usr/bin/python
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 class Stats:
     @staticmethod
     def uploaded_blocks(peer_ids, history):
@@ -10,13 +16,8 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        return dict((peer_id, history.blocks_uploaded[peer_id])
+                    for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -53,4 +54,85 @@ class Stats:
         if None in d.values():
             return None
         return max(d.values())
-    
+
+    @staticmethod
+    def downloaded_blocks(peer_ids, history):
+        """dict: peer_id -> total blocks downloaded"""
+        return dict((peer_id, history.blocks_downloaded[peer_id])
+                    for peer_id in peer_ids)
+
+    @staticmethod
+    def throughput(peer_ids, history):
+        """
+        Returns dict: peer_id -> list of the blocks the peer downloaded
+        in each round the history keeps, from history.first_round() on.
+        """
+        return dict((peer_id, [sum(d.blocks for d in ds)
+                               for ds in history.downloads[peer_id]])
+                    for peer_id in peer_ids)
+
+    @staticmethod
+    def completion_cdf(peer_ids, history):
+        """
+        Returns a list with an entry for each round played: the fraction
+        of the peers that were done by the end of that round.
+        """
+        counts = [0] * history.num_rounds()
+        for peer_id in peer_ids:
+            r = history.round_done.get(peer_id)
+            if r is not None and r < len(counts):
+                counts[r] += 1
+        cdf = []
+        done = 0
+        for c in counts:
+            done += c
+            cdf.append(done / float(len(peer_ids)))
+        return cdf
+
+
+class ArrayStats(Stats):
+    """
+    The same stats as Stats, with the ones that go through every round
+    computed with numpy over the History's columns instead of its message
+    objects.  Much faster for thousands of peers and rounds.  Needs numpy.
+
+    throughput and completion_cdf give numpy arrays instead of lists.
+    The block totals come from the History's running totals, as in Stats.
+    """
+    @staticmethod
+    def column(c):
+        """numpy array over an array.array column, without copying it"""
+        if len(c) == 0:
+            return numpy.zeros(0, dtype=c.typecode)
+        return numpy.frombuffer(c, dtype=c.typecode)
+
+    @staticmethod
+    def throughput_grid(history):
+        """
+        2-d array: row r - history.first_round(), column i is the blocks
+        the i'th peer downloaded in round r.
+        """
+        n = len(history.peer_ids)
+        first = history.first_round()
+        rounds = history.num_rounds() - first
+        r = ArrayStats.column(history.dl_round)
+        kept = r >= first
+        cells = (r[kept] - first) * n + ArrayStats.column(history.dl_to)[kept]
+        blocks = ArrayStats.column(history.dl_blocks)[kept]
+        grid = numpy.bincount(cells, weights=blocks, minlength=rounds * n)
+        return grid.reshape(rounds, n)
+
+    @staticmethod
+    def throughput(peer_ids, history):
+        grid = ArrayStats.throughput_grid(history)
+        return dict((peer_id, grid[:, history.index[peer_id]])
+                    for peer_id in peer_ids)
+
+    @staticmethod
+    def completion_cdf(peer_ids, history):
+        rounds = history.num_rounds()
+        done = numpy.array([history.round_done[peer_id] for peer_id in peer_ids
+                            if peer_id in history.round_done], dtype=int)
+        done = done[done < rounds]
+        counts = numpy.bincount(done, minlength=rounds)
+        return numpy.cumsum(counts) / float(len(peer_ids))
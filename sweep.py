@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Runs the sim for every cell of a parameter sweep, and writes one row of
+results per cell to a CSV file.
+
+  sweep.py [--workers N] SPEC.json RESULTS.csv
+
+The spec is a JSON object.  Parameter names are the dest names of
+sim.py's options (num_pieces, blocks_per_piece, min_up_bw, ...), plus
+"agents", a list of agent arguments as on sim.py's command line:
+
+  {"fixed":  {"max_round": 500, "iters": 5, "seed": 0},
+   "grid":   {"num_pieces": [32, 64],
+              "agents": [["Seed,2", "Dummy,8"], ["Seed,2", "AmksTyrant,8"]]},
+   "random": {"samples": 100, "seed": 1,
+              "params": {"min_up_bw": [4, 8, 16],
+                         "blocks_per_piece": {"min": 4, "max": 32}}}}
+
+fixed: the same in every cell.
+grid: every combination of these values is a cell.
+random: for each grid cell, this many samples, each with values drawn
+  from a list, or uniformly between min and max.
+
+Cells run in a pool of worker processes that live for the whole sweep,
+so agent modules are only loaded once per worker.  Each row is written
+as soon as its cell is done, and every cell has an id made from its
+parameters, so a sweep that was stopped can be run again with the same
+results file, and only the missing cells will run.
+"""
+
+import os
+import sys
+import csv
+import json
+import random
+import hashlib
+import logging
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+import sim
+from stats import Stats
+from util import mean, stddev
+
+
+# Columns that come after the sweep's parameters.  completion_by_class
+# averages the iterations where a class's peers finished; for each class,
+# unfinished_by_class counts the (peer, iteration) pairs where they didn't.
+RESULT_COLUMNS = ["done", "done_round_mean", "done_round_stddev",
+                  "completion_by_class", "unfinished_by_class",
+                  "uploaded_by_class"]
+
+
+def option_names():
+    """The sim options that cells can set"""
+    (options, agents) = sim.parse_args(["sweep.py"])
+    return set(vars(options))
+
+
+def expand(spec):
+    """List of the spec's cells, each a dict : param -> value"""
+    fixed = spec.get("fixed", dict())
+    grid = spec.get("grid", dict())
+    random_spec = spec.get("random")
+
+    names = set(fixed) | set(grid)
+    if random_spec is not None:
+        names |= set(random_spec["params"])
+    unknown = names - option_names() - set(["agents"])
+    if unknown:
+        raise ValueError("Unknown parameters: %s" % ", ".join(sorted(unknown)))
+
+    grid_names = sorted(grid)
+    grid_cells = [dict(zip(grid_names, values)) for values in
+                  itertools.product(*[grid[name] for name in grid_names])]
+
+    if random_spec is None:
+        samples = [dict()]
+    else:
+        rng = random.Random(random_spec.get("seed", 0))
+        params = random_spec["params"]
+        samples = []
+        for i in range(random_spec["samples"]):
+            sample = dict()
+            for name in sorted(params):
+                sample[name] = draw(rng, params[name])
+            samples.append(sample)
+
+    cells = []
+    for g in grid_cells:
+        for sample in samples:
+            cell = dict(fixed)
+            cell.update(g)
+            cell.update(sample)
+            cells.append(cell)
+    return cells
+
+
+def draw(rng, values):
+    """A value from a list of choices, or a {"min": .., "max": ..} range"""
+    if isinstance(values, list):
+        return rng.choice(values)
+    (lo, hi) = (values["min"], values["max"])
+    if isinstance(lo, int) and isinstance(hi, int):
+        return rng.randint(lo, hi)
+    return rng.uniform(lo, hi)
+
+
+def cell_id(cell):
+    """Id that only depends on the cell's parameters"""
+    return hashlib.sha1(json.dumps(cell, sort_keys=True)).hexdigest()[:16]
+
+
+def make_config(cell):
+    """
+    The sim config for a cell.  Raises ValueError if the cell's options
+    are bad, with the same checks as sim.py's command line.
+    """
+    (options, agents) = sim.parse_args(["sweep.py"])
+    options.seed = 0
+    for (name, value) in cell.items():
+        if name != "agents":
+            setattr(options, name, value)
+    if "agents" in cell:
+        agents = sim.parse_agents(cell["agents"])
+    # Cells already run in parallel, and a pool worker can't start
+    # processes of its own.
+    options.workers = 1
+    options.agent_hosts = 0
+    options.replay_iter = None
+    options.quiet = True
+    sim.check_options(options)
+    return sim.make_config(options, agents)
+
+
+def by_class(config, peer_ids, values, summary=None):
+    """
+    values: dict : peer_id -> list of numbers, one per iteration
+    summary: turns a class's list into one number.  By default, its mean,
+        or None if it's empty.
+    Returns dict : agent class -> summary of its peers' numbers
+    """
+    if summary is None:
+        summary = lambda vs: mean(vs) if vs else None
+    classes = dict()
+    for (class_name, peer_id) in zip(config.agent_class_names, peer_ids):
+        classes.setdefault(class_name, []).extend(values[peer_id])
+    return dict((class_name, summary(vs))
+                for (class_name, vs) in classes.items())
+
+
+def run_cell(cell):
+    """Worker entry point: run every iteration of a cell, return its row"""
+    config = make_config(cell)
+    s = sim.Sim(config)
+    s.peer_ids = s.make_peer_ids()
+    for peer_id in s.peer_ids:
+        s.up_bw(peer_id)
+
+    done_rounds = []
+    completion = dict((peer_id, []) for peer_id in s.peer_ids)
+    # peer_id -> the seeds of the iterations the peer didn't finish
+    unfinished = dict((peer_id, []) for peer_id in s.peer_ids)
+    uploaded = dict((peer_id, []) for peer_id in s.peer_ids)
+    for seed in s.iteration_seeds():
+        history = s.run_sim_once(seed)
+        done = Stats.all_done_round(s.peer_ids, history)
+        if done is not None:
+            done_rounds.append(done)
+        rounds = Stats.completion_rounds(s.peer_ids, history)
+        blocks = Stats.uploaded_blocks(s.peer_ids, history)
+        for peer_id in s.peer_ids:
+            if rounds[peer_id] is not None:
+                completion[peer_id].append(rounds[peer_id])
+            else:
+                unfinished[peer_id].append(seed)
+            uploaded[peer_id].append(blocks[peer_id])
+
+    row = dict(cell)
+    if "agents" in row:
+        row["agents"] = " ".join(row["agents"])
+    row["cell_id"] = cell_id(cell)
+    row["done"] = len(done_rounds)
+    row["done_round_mean"] = mean(done_rounds) if done_rounds else ""
+    row["done_round_stddev"] = stddev(done_rounds) if done_rounds else ""
+    row["completion_by_class"] = json.dumps(
+        by_class(config, s.peer_ids, completion), sort_keys=True)
+    row["unfinished_by_class"] = json.dumps(
+        by_class(config, s.peer_ids, unfinished, len), sort_keys=True)
+    row["uploaded_by_class"] = json.dumps(
+        by_class(config, s.peer_ids, uploaded), sort_keys=True)
+    return row
+
+
+def init_worker(loglevel):
+    logging.getLogger('').setLevel(loglevel)
+    # Agents print in post_init; keep the sweep's output readable.
+    sys.stdout = open(os.devnull, 'w')
+
+
+def finished_cells(path, columns):
+    """Ids of the cells already in the results file at path"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != columns:
+            raise ValueError("%s has different columns than this sweep" % path)
+        return set(row["cell_id"] for row in reader)
+
+
+def drop_partial_row(path):
+    """If the sweep was killed in the middle of writing a row, cut it off"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith("\n"):
+            f.truncate(data.rfind("\n") + 1)
+
+
+def check_cells(cells):
+    """Raise ValueError if any cell has bad options"""
+    for cell in cells:
+        try:
+            make_config(cell)
+        except ValueError, e:
+            raise ValueError("Cell %s: %s" % (json.dumps(cell, sort_keys=True),
+                                              e))
+
+
+def run_sweep(spec, path, workers):
+    cells = expand(spec)
+    names = sorted(set(itertools.chain.from_iterable(cells)))
+    columns = ["cell_id"] + names + RESULT_COLUMNS
+
+    # Bad cells stop the sweep here, not in a worker partway through
+    check_cells(cells)
+
+    drop_partial_row(path)
+    done = finished_cells(path, columns)
+    todo = [cell for cell in cells if cell_id(cell) not in done]
+    logging.warning("%d cells, %d already done, running %d",
+                    len(cells), len(cells) - len(todo), len(todo))
+
+    new_file = not os.path.exists(path)
+    with open(path, "a") as f:
+        writer = csv.DictWriter(f, columns)
+        if new_file:
+            writer.writeheader()
+            f.flush()
+        pool = multiprocessing.Pool(workers, init_worker,
+                                    (logging.getLogger('').level,))
+        try:
+            for (i, row) in enumerate(pool.imap_unordered(run_cell, todo)):
+                writer.writerow(row)
+                # Every finished row is a checkpoint
+                f.flush()
+                logging.info("Cell %s done (%d of %d)", row["cell_id"],
+                             i + 1, len(todo))
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def main(args):
+    usage_msg = "Usage: %prog [options] SPEC.json RESULTS.csv"
+    parser = OptionParser(usage=usage_msg)
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="info",
+                      help="Set the logging level: 'debug' or 'info'")
+    parser.add_option("--workers",
+                      dest="workers", default=multiprocessing.cpu_count(),
+                      type="int",
+                      help="Number of processes to run cells in")
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+    if options.workers < 1:
+        print "Error: --workers must be at least 1\n"
+        sys.exit(1)
+
+    sim.configure_logging(options.loglevel)
+    with open(args[0]) as f:
+        spec = json.load(f)
+    try:
+        check_cells(expand(spec))
+    except ValueError, e:
+        print "Error: %s\n" % e
+        sys.exit(1)
+    run_sweep(spec, args[1], options.workers)
+
+if __name__ == "__main__":
+    main(sys.argv)
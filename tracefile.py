@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+Binary trace of a sim run: everything in its History, written a round
+at a time as the sim runs, so it can be analysed or replayed later
+without running the agents again.
+
+  sim.py --trace run{seed}.trace ...
+
+  reader = TraceReader("run17.trace")
+  Stats.completion_rounds(reader.peer_ids, reader.history())
+  for (round, downloads, uploads, done) in reader.replay(): ...
+
+The module is called tracefile so that it doesn't hide Python's trace
+module.
+
+Layout (all numbers little-endian):
+
+  magic       8 bytes, "BTTRACE1"
+  header      uint32 length, then that many bytes of JSON:
+              {"peer_ids": [...], "upload_rates": {peer_id: bw},
+               "num_pieces": n, "blocks_per_piece": n}
+  rounds      one block per round, in order:
+              int32 round, new ids, downloads, uploads, done
+              new ids * (uint16 length, bytes)
+              downloads * (int32 from, int32 to, int32 piece, float64 blocks)
+              uploads * (int32 from, int32 to, float64 bw)
+              done * (int32 peer)
+
+Peers are numbered by their place in peer_ids.  Uploads to anything
+else go to history.NOT_A_PEER, which is given the next number when it
+first shows up, in the "new ids" of that round.  Within a round, downloads are in the order of
+the peer they went to, and uploads in the order of the peer they came
+from, the same as in a History.
+"""
+
+import json
+import mmap
+import struct
+
+from messages import Upload, Download
+from history import History
+from util import whole_to_int
+
+MAGIC = "BTTRACE1"
+LENGTH = struct.Struct("<I")
+ROUND = struct.Struct("<iiiii")
+ID_LENGTH = struct.Struct("<H")
+DOWNLOAD = struct.Struct("<iiid")
+UPLOAD = struct.Struct("<iid")
+DONE = struct.Struct("<i")
+
+
+class TraceWriter:
+    """Writes a History to a trace file, one round at a time"""
+    def __init__(self, path, history, config):
+        self.f = open(path, "wb")
+        self.history = history
+        header = json.dumps({"peer_ids": history.peer_ids,
+                             "upload_rates": history.upload_rates,
+                             "num_pieces": config.num_pieces,
+                             "blocks_per_piece": config.blocks_per_piece})
+        self.f.write(MAGIC)
+        self.f.write(LENGTH.pack(len(header)))
+        self.f.write(header)
+        # How many of history.ids the trace has
+        self.ids_written = len(history.peer_ids)
+        self.done_written = set()
+
+    def write_round(self, r):
+        """Write round r, which must be the history's last round"""
+        h = self.history
+        n = len(h.peer_ids)
+        j = (r - h.stored_from) * n
+        dl = range(h.dl_offsets[j], h.dl_offsets[j + n])
+        ul = range(h.ul_offsets[j], h.ul_offsets[j + n])
+        new_ids = h.ids[self.ids_written:]
+        self.ids_written = len(h.ids)
+        done = []
+        if len(h.round_done) > len(self.done_written):
+            done = [h.index[pid] for pid in sorted(h.round_done)
+                    if pid not in self.done_written]
+            self.done_written.update(h.ids[i] for i in done)
+
+        out = [ROUND.pack(r, len(new_ids), len(dl), len(ul), len(done))]
+        for peer_id in new_ids:
+            b = str(peer_id)
+            out.append(ID_LENGTH.pack(len(b)))
+            out.append(b)
+        for k in dl:
+            out.append(DOWNLOAD.pack(h.dl_from[k], h.dl_to[k], h.dl_piece[k],
+                                     h.dl_blocks[k]))
+        for k in ul:
+            out.append(UPLOAD.pack(h.ul_from[k], h.ul_to[k], h.ul_bw[k]))
+        for i in done:
+            out.append(DONE.pack(i))
+        self.f.write("".join(out))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class TraceRound:
+    """Where one round's records are in the trace"""
+    def __init__(self, round, downloads_at, num_downloads, uploads_at,
+                 num_uploads, done):
+        self.round = round
+        self.downloads_at = downloads_at
+        self.num_downloads = num_downloads
+        self.uploads_at = uploads_at
+        self.num_uploads = num_uploads
+        self.done = done  # peer numbers done this round
+
+
+class TraceReader:
+    """
+    Reads a trace through a memory map.  Opening it only goes through the
+    round headers; the records are read when they're asked for.
+
+    reader.peer_ids, reader.upload_rates: from the header
+    reader.ids: every id in the trace, peers first
+    reader.round_done: dict : peer_id -> round it finished
+    """
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a trace file" % path)
+        pos = len(MAGIC)
+        (length,) = LENGTH.unpack_from(data, pos)
+        pos += LENGTH.size
+        header = json.loads(data[pos:pos + length])
+        pos += length
+
+        self.peer_ids = [str(pid) for pid in header["peer_ids"]]
+        self.upload_rates = dict((str(pid), bw) for (pid, bw)
+                                 in header["upload_rates"].items())
+        self.num_pieces = header["num_pieces"]
+        self.blocks_per_piece = header["blocks_per_piece"]
+        self.ids = self.peer_ids[:]
+        self.round_done = dict()
+
+        self.rounds = []
+        while pos + ROUND.size <= len(data):
+            (r, num_ids, num_dl, num_ul, num_done) = ROUND.unpack_from(data, pos)
+            pos += ROUND.size
+            new_ids = []
+            for k in range(num_ids):
+                if pos + ID_LENGTH.size > len(data):
+                    break
+                (n,) = ID_LENGTH.unpack_from(data, pos)
+                pos += ID_LENGTH.size
+                new_ids.append(data[pos:pos + n])
+                pos += n
+            downloads_at = pos
+            pos += num_dl * DOWNLOAD.size
+            uploads_at = pos
+            pos += num_ul * UPLOAD.size
+            done_at = pos
+            pos += num_done * DONE.size
+            if pos > len(data):
+                # The sim was stopped in the middle of writing this round
+                break
+            self.ids.extend(new_ids)
+            done = [DONE.unpack_from(data, done_at + k * DONE.size)[0]
+                    for k in range(num_done)]
+            for i in done:
+                self.round_done[self.ids[i]] = r
+            self.rounds.append(TraceRound(r, downloads_at, num_dl,
+                                          uploads_at, num_ul, done))
+
+    def num_rounds(self):
+        return len(self.rounds)
+
+    def downloads(self, r):
+        """dict : peer_id -> [Download] to that peer in round r"""
+        t = self.rounds[r]
+        ids = self.ids
+        dls = dict((pid, []) for pid in self.peer_ids)
+        for k in xrange(t.num_downloads):
+            (f, to, piece, blocks) = DOWNLOAD.unpack_from(
+                self.data, t.downloads_at + k * DOWNLOAD.size)
+            dls[ids[to]].append(Download(ids[f], ids[to], piece,
+                                         whole_to_int(blocks)))
+        return dls
+
+    def uploads(self, r):
+        """dict : peer_id -> [Upload] from that peer in round r"""
+        t = self.rounds[r]
+        ids = self.ids
+        ups = dict((pid, []) for pid in self.peer_ids)
+        for k in xrange(t.num_uploads):
+            (f, to, bw) = UPLOAD.unpack_from(
+                self.data, t.uploads_at + k * UPLOAD.size)
+            ups[ids[f]].append(Upload(ids[f], ids[to], whole_to_int(bw)))
+        return ups
+
+    def replay(self):
+        """
+        Generator of the rounds in order: (round, downloads, uploads, done),
+        with downloads and uploads as from downloads(r) and uploads(r), and
+        done the ids of the peers that finished in the round.
+        """
+        for t in self.rounds:
+            yield (t.round, self.downloads(t.round), self.uploads(t.round),
+                   [self.ids[i] for i in t.done])
+
+    def history(self, window=0, recent_rounds=3):
+        """A History with everything in the trace, e.g. for Stats"""
+        h = History(self.peer_ids, self.upload_rates, window, recent_rounds)
+        for (r, dls, ups, done) in self.replay():
+            for pid in done:
+                h.peer_is_done(r, pid)
+            h.update(dls, ups)
+        return h
+
+    def close(self):
+        self.data.close()
+        self.f.close()
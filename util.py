@@ -55,6 +55,165 @@ def median(numeric):
         return (float(lower + upper)) / 2
 
 
+class RunningStats:
+    """
+    Mean and standard deviation of numbers added one at a time, without
+    keeping them (Welford's method).  Same results as mean() and stddev()
+    on the list of numbers.
+
+    >>> xs = [2, 4, 4, 4, 5, 5, 7, 9]
+    >>> s = RunningStats()
+    >>> for x in xs: s.add(x)
+    >>> (s.mean(), mean(xs))
+    (5.0, 5.0)
+    >>> (s.stddev() ** 2, stddev(xs) ** 2)
+    (4.0, 4.0)
+    """
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.m = 0.0   # running mean
+        self.m2 = 0.0  # sum of squared differences from the mean
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        d = x - self.m
+        self.m += d / float(self.n)
+        self.m2 += d * (x - self.m)
+
+    def mean(self):
+        """Throws a div by zero exception if nothing was added"""
+        return self.total / float(self.n)
+
+    def stddev(self):
+        if self.n == 0:
+            return 0
+        return math.sqrt(self.m2 / self.n)
+
+
+class P2Quantile:
+    """
+    Estimate of the p quantile (e.g. 0.5 for the median) of numbers added
+    one at a time, in constant space: the P-squared algorithm of Jain and
+    Chlamtac.  The first few numbers are kept, and their quantile is exact;
+    the estimate starts from them once there are more.
+
+    >>> q = P2Quantile(0.5)
+    >>> for x in [5, 1, 4, 2, 3]: q.add(x)
+    >>> q.value()
+    3.0
+    >>> q = P2Quantile(0.99)
+    >>> q.add(7)
+    >>> q.value()
+    7.0
+
+    The quantiles of 1..1000 are 1 + 999p:
+
+    >>> import random
+    >>> xs = range(1, 1001)
+    >>> random.Random(0).shuffle(xs)
+    >>> for p in (0.5, 0.95, 0.99):
+    ...     q = P2Quantile(p)
+    ...     for x in xs: q.add(x)
+    ...     (exact, v) = (1 + 999 * p, q.value())
+    ...     print p, exact, round(v, 1), abs(v / exact - 1) < 0.005
+    0.5 500.5 501.1 True
+    0.95 950.05 952.3 True
+    0.99 990.01 991.9 True
+    """
+    def __init__(self, p, exact=100):
+        """exact: how many numbers to keep before estimating (at least 5)"""
+        self.p = p
+        self.n = 0
+        self.exact = max(5, exact)
+        self.values = []  # the numbers so far, until there are too many
+        # Quantiles that the five markers track
+        self.fractions = [0, p/2.0, p, (1 + p)/2.0, 1]
+        self.heights = None    # marker heights, once estimating
+        self.positions = None  # marker positions, counting from 1
+        self.desired = None    # where the markers should be
+
+    def add(self, x):
+        self.n += 1
+        if self.heights is None:
+            self.values.append(x)
+            if len(self.values) > self.exact:
+                self.start()
+            return
+
+        q = self.heights
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.fractions[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if ((d >= 1 and n[i + 1] - n[i] > 1) or
+                (d <= -1 and n[i - 1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                h = self.parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def start(self):
+        """Put the markers on the kept numbers, and stop keeping them"""
+        vals = sorted(self.values)
+        m = len(vals)
+        n = [int(round(f * (m - 1))) + 1 for f in self.fractions]
+        # The markers need distinct positions
+        for i in (1, 2, 3):
+            n[i] = max(n[i], n[i - 1] + 1)
+        for i in (3, 2, 1, 0):
+            n[i] = min(n[i], n[i + 1] - 1)
+        self.positions = n
+        self.heights = [float(vals[k - 1]) for k in n]
+        self.desired = [1 + f * (m - 1) for f in self.fractions]
+        self.values = None
+
+    def parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        """The estimate, or None if nothing was added"""
+        if self.n == 0:
+            return None
+        if self.heights is None:
+            # Interpolate between the numbers, like median()
+            vals = sorted(self.values)
+            pos = self.p * (self.n - 1)
+            i = int(pos)
+            if i + 1 == self.n:
+                return float(vals[i])
+            return vals[i] + (pos - i) * (vals[i + 1] - vals[i])
+        return self.heights[2]
+
+
+def whole_to_int(x):
+    """x as an int if it is a whole number, otherwise x"""
+    i = int(x)
+    if i == x:
+        return i
+    return x
+
 
 def even_split(n, k):
     """